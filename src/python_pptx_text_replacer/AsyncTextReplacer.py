@@ -0,0 +1,144 @@
+# -*- encoding: utf-8 -*-
+"""
+This module implements an asyncio facade for TextReplacer.
+
+Loading, replacing and saving a presentation is CPU bound and blocks for
+seconds on big decks. The facade runs the whole job in a thread or process
+executor, so the event loop keeps running. The number of jobs in flight is
+bounded, callers beyond that bound wait for a free slot (backpressure), and
+awaiting callers can be cancelled at any time.
+"""
+import asyncio
+import io
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+from .TextReplacer import TextReplacer, CancellationToken, _write_file_atomically
+
+_REPLACE_TEXT_OPTIONS = ( 'use_regex', 'edit_slide_master', 'master_cache', 'progress' )
+
+
+def _replace_presentation(src, replacements, options, replace_options, cancellation_token):
+    # runs inside the executor, so it must be a picklable module level function
+    replacer = TextReplacer(src, **options)
+    replacer.replace_text(replacements, cancellation_token=cancellation_token, **replace_options)
+    stream = io.BytesIO()
+    replacer.write_presentation_to_file(stream)
+    return stream.getvalue()
+
+
+class AsyncTextReplacer:
+    """
+    This class runs text replacements in an executor without blocking the event loop.
+
+    executor (optional) can be any concurrent.futures executor - a ThreadPoolExecutor
+    or a ProcessPoolExecutor. If none is given, a ThreadPoolExecutor with
+    max_concurrency workers is created and owned by this instance.
+    max_concurrency limits the number of replacement jobs running at the same time.
+    Further calls to replace() wait until one of the running jobs finished.
+    """
+
+    def __init__(self, executor=None, max_concurrency=4):
+        if max_concurrency < 1:
+            raise ValueError("max_concurrency must be at least 1, not %s." % ( max_concurrency ))
+        self._own_executor = executor is None
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency) if executor is None else executor
+        self._max_concurrency = max_concurrency
+        # asyncio primitives belong to the event loop they are used in first,
+        # so every running loop gets a semaphore of its own
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    async def replace(self, src, replacements, output=None, **options):
+        """
+        Replace text in presentation file src and return the changed presentation as bytes
+        or, if output is given, write it to the file named output and return output.
+
+        options are the named parameters of TextReplacer and TextReplacer.replace_text.
+        A master_cache can only be shared by jobs running in threads of this process.
+        progress is called in the thread or process running the job and a cancellation_token
+        can only be cancelled from the outside for jobs running in threads.
+
+        When the calling task is cancelled while its job is still waiting for the
+        executor, the job is dropped. A job that is already running in a thread is
+        stopped at the next slide or shape. A job running in another process can't be
+        reached and is completed in the background. Either way, no output file is written.
+        """
+        replace_options = dict((name, options.pop(name)) for name in _REPLACE_TEXT_OPTIONS if name in options)
+        replacements = list(replacements)
+        # the job is stopped when the caller's token or the awaiting task is cancelled
+        cancellation_token = CancellationToken(parent=options.pop('cancellation_token', None))
+
+        loop = asyncio.get_running_loop()
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self._semaphores[loop] = asyncio.Semaphore(self._max_concurrency)
+
+        await semaphore.acquire()
+        try:
+            future = self._executor.submit(_replace_presentation, src, replacements, options, replace_options,
+                                           cancellation_token)
+        except BaseException:
+            semaphore.release()
+            raise
+
+        def release(_future):
+            # the slot is only given free once the executor really finished the job,
+            # even if the awaiting task got cancelled long before
+            try:
+                loop.call_soon_threadsafe(semaphore.release)
+            except RuntimeError:
+                pass # event loop is closed already
+        future.add_done_callback(release)
+
+        # cancelling the awaiting task cancels the wrapped future as well,
+        # which drops the job, if it didn't start yet
+        try:
+            data = await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            cancellation_token.cancel()
+            raise
+
+        if output is None:
+            return data
+        await loop.run_in_executor(None, _write_file_atomically, output, lambda f: f.write(data))
+        return output
+
+    def close(self):
+        """
+        Shut down the executor, if it was created by this instance. This blocks until
+        all running jobs are finished, so use aclose() inside the event loop.
+        """
+        if self._own_executor:
+            self._executor.shutdown(wait=True)
+
+    async def aclose(self):
+        """
+        Shut down the executor, if it was created by this instance, without blocking the event loop.
+        """
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.aclose()
+
+
+_default_replacer = None
+
+
+async def replace_async(src, replacements, output=None, replacer=None, **options):
+    """
+    Replace text in presentation file src without blocking the event loop.
+
+    Returns the changed presentation as bytes or, if output is given, writes it to
+    the file named output and returns output. replacer is the AsyncTextReplacer
+    to run the job with - a shared default with a thread pool is used if it is omitted.
+    options are the named parameters of TextReplacer and TextReplacer.replace_text.
+    """
+    global _default_replacer
+    if replacer is None:
+        if _default_replacer is None:
+            _default_replacer = AsyncTextReplacer()
+        replacer = _default_replacer
+    return await replacer.replace(src, replacements, output=output, **options)
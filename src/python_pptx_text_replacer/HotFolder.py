@@ -0,0 +1,321 @@
+# -*- encoding: utf-8 -*-
+"""
+This module implements a hot folder for text replacement in Powerpoint files.
+
+An input directory is watched for new or changed presentations. Files still being
+written are left alone until their size and modification time haven't changed for
+a while (debouncing). Ready files are processed by a pool of worker processes,
+which keep python-pptx loaded between files, and the changed presentations are
+written to the output directory atomically. A status file records throughput
+and failures.
+"""
+from __future__ import print_function, unicode_literals
+
+import argparse
+import json
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from .TextReplacer import TextReplacer, SlideMasterCache, __version__, _add_replacement_arguments, \
+                          _add_selection_arguments, _write_file_atomically
+
+# the slide masters edited in a worker process, reused for all files it processes
+_master_cache = SlideMasterCache()
+
+
+def _process_file(input_file_name, output_file_name, replacements, options, replace_options):
+    # runs inside a worker process, so it must be a picklable module level function
+    replacer = TextReplacer(input_file_name, quiet=True, **options)
+    replacer.replace_text(replacements, master_cache=_master_cache, **replace_options)
+    replacer.write_presentation_to_file(output_file_name)
+    return replacer.get_run_stats()
+
+
+class HotFolder:
+    """
+    This class watches input_dir and writes the changed presentations to output_dir.
+
+    replacements is the list of ( match, replacement ) tuples applied to each file.
+    options are the named parameters of TextReplacer and replace_options the ones of
+    TextReplacer.replace_text (except master_cache, every worker process reuses the
+    slide masters it edited on its own). A file is processed once its size and
+    modification time have been unchanged for debounce seconds. workers is the number
+    of worker processes (default is the number of CPUs). If status_file is given, it is rewritten after
+    every finished file.
+    """
+
+    def __init__(self, input_dir, output_dir, replacements,
+                 options=None,
+                 replace_options=None,
+                 workers=None,
+                 debounce=2.0,
+                 interval=1.0,
+                 status_file=None,
+                 verbose=False):
+        if not os.path.isdir(input_dir):
+            raise ValueError("Input directory %s does not exist." % ( input_dir ))
+        if not os.path.isdir(output_dir):
+            raise ValueError("Output directory %s does not exist." % ( output_dir ))
+        if os.path.abspath(input_dir) == os.path.abspath(output_dir):
+            raise ValueError("Input and output directory must not be the same.")
+        self._input_dir = input_dir
+        self._output_dir = output_dir
+        self._replacements = list(replacements)
+        self._options = options or {}
+        self._replace_options = replace_options or {}
+        self._workers = workers
+        self._debounce = debounce
+        self._interval = interval
+        self._status_file = status_file
+        self._verbose = verbose
+        self._executor = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._seen = {}        # file name -> ( signature, time the signature was first seen )
+        self._processed = {}   # file name -> signature of the last processed version
+        self._running = {}     # file name -> signature of the version being processed
+        self._start_time = time.time()
+        self._status = {
+            'input_dir': os.path.abspath(input_dir),
+            'output_dir': os.path.abspath(output_dir),
+            'processed': 0,
+            'failed': 0,
+            'matches': 0,
+            'queued': 0,
+            'running': 0,
+            'files_per_minute': 0.0,
+            'failures': [],
+        }
+
+    def _is_candidate(self, file_name):
+        # skip hidden and temporary files as well as PowerPoint's lock files (~$...)
+        return file_name.lower().endswith('.pptx') and not file_name.startswith(('.', '~$'))
+
+    def scan(self):
+        """
+        Return the names of all files in the input directory, that are ready to be processed.
+        """
+        now = time.time()
+        ready = []
+        present = set()
+        for entry in os.scandir(self._input_dir):
+            if not entry.is_file() or not self._is_candidate(entry.name):
+                continue
+            present.add(entry.name)
+            stat = entry.stat()
+            signature = ( stat.st_size, stat.st_mtime_ns )
+            seen = self._seen.get(entry.name)
+            if seen is None or seen[0] != signature:
+                # new or still changing - (re)start its debounce period
+                self._seen[entry.name] = ( signature, now )
+                if self._debounce > 0:
+                    continue
+                seen = self._seen[entry.name]
+            if now - seen[1] < self._debounce:
+                continue
+            with self._lock:
+                if self._processed.get(entry.name) == signature or entry.name in self._running:
+                    continue
+            ready.append(entry.name)
+        for file_name in set(self._seen) - present:
+            del self._seen[file_name]
+        return sorted(ready)
+
+    def poll(self):
+        """
+        Scan the input directory once and hand all ready files to the worker pool.
+        Return the futures of the submitted jobs.
+        """
+        futures = []
+        for file_name in self.scan():
+            signature = self._seen[file_name][0]
+            try:
+                future = self._submit(file_name)
+            except BrokenProcessPool as err:
+                with self._lock:
+                    self._processed[file_name] = signature
+                    self._record_failure(file_name, err)
+                self.write_status()
+                continue
+            with self._lock:
+                self._running[file_name] = signature
+                self._status['queued'] += 1
+            future.add_done_callback(lambda f, file_name=file_name, signature=signature: self._done(file_name, signature, f))
+            futures.append(future)
+            if self._verbose:
+                print("Queued %s" % ( file_name ))
+        return futures
+
+    def _submit(self, file_name):
+        args = ( _process_file,
+                 os.path.join(self._input_dir, file_name),
+                 os.path.join(self._output_dir, file_name),
+                 self._replacements, self._options, self._replace_options )
+        if self._executor is not None:
+            try:
+                return self._executor.submit(*args)
+            except BrokenProcessPool:
+                # A worker process died (killed by the OOM killer, for example) and took
+                # the pool down with it. The files it was running fail with BrokenProcessPool,
+                # all further files go to a new pool.
+                self._executor.shutdown(wait=False)
+                self._executor = None
+        self._executor = ProcessPoolExecutor(max_workers=self._workers)
+        return self._executor.submit(*args)
+
+    def _record_failure(self, file_name, error):
+        self._status['failed'] += 1
+        message = "".join(traceback.format_exception_only(type(error), error)).strip()
+        self._status['failures'] = (self._status['failures'] + [ {
+            'file': file_name,
+            'error': message,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        } ])[-100:]
+        print("Processing %s failed: %s" % ( file_name, message ), file=sys.stderr)
+
+    def _done(self, file_name, signature, future):
+        with self._lock:
+            del self._running[file_name]
+            self._status['queued'] -= 1
+            error = future.exception()
+            # a failed file isn't tried again until it changed
+            self._processed[file_name] = signature
+            if error is None:
+                self._status['processed'] += 1
+                self._status['matches'] += future.result().get('matches', 0)
+                if self._verbose:
+                    print("Processed %s" % ( file_name ))
+            else:
+                self._record_failure(file_name, error)
+        self.write_status()
+
+    def get_status(self):
+        with self._lock:
+            status = dict(self._status)
+            status['running'] = len(self._running)
+            elapsed = time.time() - self._start_time
+            status['elapsed'] = elapsed
+            status['files_per_minute'] = 60.0 * (status['processed'] + status['failed']) / elapsed if elapsed > 0 else 0.0
+            return status
+
+    def write_status(self):
+        if self._status_file is None:
+            return
+        data = json.dumps(self.get_status(), indent=2).encode('utf-8')
+        _write_file_atomically(self._status_file, lambda f: f.write(data))
+
+    def run(self):
+        """
+        Watch the input directory until stop() is called and wait for all running jobs thereafter.
+        """
+        try:
+            while not self._stop.is_set():
+                self.poll()
+                self._stop.wait(self._interval)
+        finally:
+            self.close()
+
+    def stop(self):
+        self._stop.set()
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        self.write_status()
+
+
+def main(argv):
+    p = argparse.ArgumentParser(prog='python-pptx-text-replacer watch',
+                                description=__doc__,
+                                formatter_class=argparse.RawDescriptionHelpFormatter,
+                                epilog="python-pptx-text-replacer %s" % __version__)
+    _add_replacement_arguments(p)
+    p.add_argument('--verbose','-v',
+                   action='store_const',
+                   dest='verbose',
+                   const=True,
+                   required=False,
+                   default=False,
+                   help="print the files queued and processed")
+    p.add_argument('--regex','-x',
+                   action='store_const',
+                   dest='use_regex',
+                   const=True,
+                   required=False,
+                   default=False,
+                   help="use match strings as regular expressions")
+    p.add_argument('--input-dir', '-i',
+                   action='store',
+                   required=True,
+                   metavar='<input directory>',
+                   help="the directory to watch for presentations")
+    p.add_argument('--output-dir', '-o',
+                   action='store',
+                   required=True,
+                   metavar='<output directory>',
+                   help="the directory to write the changed presentations to")
+    _add_selection_arguments(p)
+    p.add_argument('--workers', '-w',
+                   action='store',
+                   type=int,
+                   required=False,
+                   default=None,
+                   metavar='<number of worker processes>',
+                   help="the number of worker processes (default: number of CPUs)")
+    p.add_argument('--debounce', '-d',
+                   action='store',
+                   type=float,
+                   required=False,
+                   default=2.0,
+                   metavar='<seconds>',
+                   help="seconds a file must stay unchanged before it is processed (default: 2)")
+    p.add_argument('--interval',
+                   action='store',
+                   type=float,
+                   required=False,
+                   default=1.0,
+                   metavar='<seconds>',
+                   help="seconds between two scans of the input directory (default: 1)")
+    p.add_argument('--status-file',
+                   action='store',
+                   required=False,
+                   default=None,
+                   metavar='<status file>',
+                   help="the JSON file to record throughput and failures in")
+
+    ns = p.parse_args(argv)
+
+    if len(ns.matches) != len(ns.replacements):
+        print("There must be as many match-strings (-m) as there are replacement-strings (-r)", file=sys.stderr)
+        return 1
+
+    try:
+        hot_folder = HotFolder(ns.input_dir, ns.output_dir,
+                               list(zip(ns.matches, ns.replacements)),
+                               options=dict(tables=ns.tables,
+                                            charts=ns.charts,
+                                            textframes=ns.textframes,
+                                            slides=ns.slides),
+                               replace_options=dict(use_regex=ns.use_regex),
+                               workers=ns.workers,
+                               debounce=ns.debounce,
+                               interval=ns.interval,
+                               status_file=ns.status_file,
+                               verbose=ns.verbose)
+    except ValueError as err:
+        print(str(err.args[0]), file=sys.stderr)
+        return 1
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: hot_folder.stop())
+    try:
+        hot_folder.run()
+    except KeyboardInterrupt:
+        hot_folder.stop()
+    return 0
@@ -0,0 +1,363 @@
+# -*- encoding: utf-8 -*-
+"""
+This module implements a job queue for text replacement in Powerpoint files.
+
+The queue is a SQLite database, which can live on a filesystem shared by any
+number of worker nodes. Jobs are enqueued from a manifest and claimed by workers
+with a lease, that the worker renews by heartbeats while it processes the job.
+Jobs of workers that died (their lease expired) are handed out again until they
+ran out of attempts. A report consolidates the results of all workers.
+
+The manifest is a file with one JSON object per line, like
+
+    {"input": "decks/a.pptx", "output": "out/a.pptx", "replacements": [["FY2021", "FY2122"]]}
+
+Further optional keys are the named parameters of TextReplacer (tables, charts,
+textframes, slides) and of TextReplacer.replace_text (use_regex, edit_slide_master).
+"""
+from __future__ import print_function, unicode_literals
+
+import argparse
+import json
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+
+from .TextReplacer import TextReplacer, SlideMasterCache, CancellationToken, ReplacementCancelled, __version__
+
+_OPTIONS = ( 'tables', 'charts', 'textframes', 'slides' )
+_REPLACE_OPTIONS = ( 'use_regex', 'edit_slide_master' )
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id            INTEGER PRIMARY KEY AUTOINCREMENT,
+    input         TEXT NOT NULL,
+    output        TEXT NOT NULL,
+    params        TEXT NOT NULL,
+    state         TEXT NOT NULL DEFAULT 'queued',
+    attempts      INTEGER NOT NULL DEFAULT 0,
+    worker        TEXT,
+    lease_expires REAL,
+    error         TEXT,
+    stats         TEXT,
+    enqueued      REAL NOT NULL,
+    started       REAL,
+    finished      REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id);
+"""
+
+
+class JobQueue:
+    """
+    This class implements a job queue in the SQLite database database.
+
+    lease is the number of seconds a claimed job belongs to a worker without a
+    heartbeat. A job is tried max_attempts times before it is marked as failed.
+    The slide masters edited by the jobs of a worker are reused from master_cache,
+    a SlideMasterCache shared by all jobs processed by this instance.
+    """
+
+    def __init__(self, database, lease=60.0, max_attempts=3, master_cache=None):
+        self._database = database
+        self._master_cache = SlideMasterCache() if master_cache is None else master_cache
+        self._lease = lease
+        self._max_attempts = max_attempts
+        self._local = threading.local()
+        self._connection().executescript(_SCHEMA)
+
+    def _connection(self):
+        # sqlite3 connections can't be shared between threads and the heartbeat runs in its own
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self._database, timeout=60.0, isolation_level=None)
+            db.row_factory = sqlite3.Row
+            self._local.db = db
+        return db
+
+    class _Transaction:
+        def __init__(self, db):
+            self._db = db
+
+        def __enter__(self):
+            # take the write lock right away, so two workers never claim the same job
+            self._db.execute("BEGIN IMMEDIATE")
+            return self._db
+
+        def __exit__(self, exc_type, exc_value, tb):
+            self._db.execute("COMMIT" if exc_type is None else "ROLLBACK")
+
+    def _transaction(self):
+        return JobQueue._Transaction(self._connection())
+
+    def enqueue(self, jobs):
+        """
+        Enqueue jobs, an iterable of dictionaries as described for the manifest, and
+        return the number of jobs enqueued.
+        """
+        rows = []
+        for job in jobs:
+            if 'input' not in job or 'output' not in job or not job.get('replacements'):
+                raise ValueError("Job %s needs an input, an output and replacements." % ( json.dumps(job) ))
+            params = dict((name, job[name]) for name in _OPTIONS + _REPLACE_OPTIONS if name in job)
+            params['replacements'] = [ list(pair) for pair in job['replacements'] ]
+            rows.append(( job['input'], job['output'], json.dumps(params), time.time() ))
+        with self._transaction() as db:
+            db.executemany("INSERT INTO jobs (input, output, params, enqueued) VALUES (?, ?, ?, ?)", rows)
+        return len(rows)
+
+    def enqueue_manifest(self, manifest_file_name):
+        jobs = []
+        with open(manifest_file_name, encoding='utf-8') as f:
+            for line_no, line in enumerate(f, start=1):
+                if len(line.strip()) == 0:
+                    continue
+                try:
+                    jobs.append(json.loads(line))
+                except ValueError as err:
+                    raise ValueError("Line %s of manifest %s is no valid JSON: %s" % ( line_no, manifest_file_name, err ))
+        return self.enqueue(jobs)
+
+    def _expire_leases(self, db, now):
+        # the workers holding these jobs died or lost contact, so hand them out again
+        db.execute("UPDATE jobs SET state='failed', worker=NULL, finished=?, error='lease expired' "
+                   "WHERE state='running' AND lease_expires<? AND attempts>=?", ( now, now, self._max_attempts ))
+        db.execute("UPDATE jobs SET state='queued', worker=NULL "
+                   "WHERE state='running' AND lease_expires<?", ( now, ))
+
+    def claim(self, worker_id):
+        """
+        Claim the next queued job for worker_id and return it as dictionary or None,
+        if there is no job left to claim.
+        """
+        now = time.time()
+        with self._transaction() as db:
+            self._expire_leases(db, now)
+            row = db.execute("SELECT * FROM jobs WHERE state='queued' ORDER BY id LIMIT 1").fetchone()
+            if row is None:
+                return None
+            db.execute("UPDATE jobs SET state='running', worker=?, attempts=attempts+1, lease_expires=?, started=? "
+                       "WHERE id=?", ( worker_id, now+self._lease, now, row['id'] ))
+        job = json.loads(row['params'])
+        job.update(id=row['id'], input=row['input'], output=row['output'], attempts=row['attempts']+1)
+        return job
+
+    def heartbeat(self, job_id, worker_id):
+        """
+        Renew the lease of job job_id. Returns False, if the job doesn't belong to worker_id anymore.
+        """
+        with self._transaction() as db:
+            cursor = db.execute("UPDATE jobs SET lease_expires=? WHERE id=? AND worker=? AND state='running'",
+                                ( time.time()+self._lease, job_id, worker_id ))
+            return cursor.rowcount == 1
+
+    def complete(self, job_id, worker_id, stats):
+        """
+        Mark job job_id as done. Returns False, if the job doesn't belong to worker_id anymore.
+        """
+        with self._transaction() as db:
+            cursor = db.execute("UPDATE jobs SET state='done', lease_expires=NULL, stats=?, error=NULL, finished=? "
+                                "WHERE id=? AND worker=? AND state='running'",
+                                ( json.dumps(stats), time.time(), job_id, worker_id ))
+            return cursor.rowcount == 1
+
+    def fail(self, job_id, worker_id, error):
+        with self._transaction() as db:
+            db.execute("UPDATE jobs SET state=CASE WHEN attempts>=? THEN 'failed' ELSE 'queued' END, "
+                       "worker=NULL, lease_expires=NULL, error=?, finished=? "
+                       "WHERE id=? AND worker=? AND state='running'",
+                       ( self._max_attempts, error, time.time(), job_id, worker_id ))
+
+    def has_unfinished_jobs(self):
+        """
+        Return True, if there are jobs queued or still running.
+        """
+        row = self._connection().execute("SELECT COUNT(*) AS cnt FROM jobs WHERE state IN ('queued', 'running')").fetchone()
+        return row['cnt'] > 0
+
+    def process(self, job, cancellation_token=None):
+        """
+        Do the text replacement of a claimed job and return the run stats.
+
+        Once cancellation_token is cancelled, the job is given up without writing its output.
+        """
+        replacer = TextReplacer(job['input'], quiet=True,
+                                **dict((name, job[name]) for name in _OPTIONS if name in job))
+        replacer.replace_text([ tuple(pair) for pair in job['replacements'] ], master_cache=self._master_cache,
+                              cancellation_token=cancellation_token,
+                              **dict((name, job[name]) for name in _REPLACE_OPTIONS if name in job))
+        if cancellation_token is not None and cancellation_token.cancelled:
+            raise ReplacementCancelled("Job %s has been cancelled." % ( job['id'] ))
+        os.makedirs(os.path.dirname(os.path.abspath(job['output'])), exist_ok=True)
+        replacer.write_presentation_to_file(job['output'])
+        return replacer.get_run_stats()
+
+    def work(self, worker_id=None, stop=None, verbose=False, poll_interval=None):
+        """
+        Claim and process jobs until there are none left (or stop, a threading.Event, is set)
+        and return the number of jobs processed by this worker.
+
+        While other workers are still running jobs, the queue is polled every poll_interval
+        seconds (default is a third of the lease, at most a second), so that the jobs of
+        workers dying now are taken over once their lease expired.
+        """
+        if worker_id is None:
+            worker_id = "%s-%s" % ( socket.gethostname(), os.getpid() )
+        if poll_interval is None:
+            poll_interval = min(1.0, self._lease/3.0)
+        processed = 0
+        while stop is None or not stop.is_set():
+            job = self.claim(worker_id)
+            if job is None:
+                if not self.has_unfinished_jobs():
+                    break
+                if stop is None:
+                    time.sleep(poll_interval)
+                else:
+                    stop.wait(poll_interval)
+                continue
+            if verbose:
+                print("%s: processing job %s (%s -> %s), attempt %s"
+                      % ( worker_id, job['id'], job['input'], job['output'], job['attempts'] ))
+            done = threading.Event()
+            lease_lost = CancellationToken()
+
+            def heartbeat(job_id=job['id']):
+                while not done.wait(self._lease/3.0):
+                    try:
+                        renewed = self.heartbeat(job_id, worker_id)
+                    except sqlite3.Error as err:
+                        # without heartbeats the lease expires and the job is handed to another worker
+                        print("%s: heartbeat of job %s failed: %s" % ( worker_id, job_id, err ), file=sys.stderr)
+                        renewed = False
+                    if not renewed:
+                        # the job has been handed to another worker, so stop working on it
+                        lease_lost.cancel()
+                        break
+            heartbeat_thread = threading.Thread(target=heartbeat)
+            heartbeat_thread.daemon = True
+            heartbeat_thread.start()
+            try:
+                stats = self.process(job, cancellation_token=lease_lost)
+            except ReplacementCancelled:
+                done.set()
+                heartbeat_thread.join()
+                print("%s: job %s (%s) lost its lease and has been given up" % ( worker_id, job['id'], job['input'] ),
+                      file=sys.stderr)
+                continue
+            except Exception as err:
+                done.set()
+                heartbeat_thread.join()
+                message = "".join(traceback.format_exception_only(type(err), err)).strip()
+                print("%s: job %s (%s) failed: %s" % ( worker_id, job['id'], job['input'], message ), file=sys.stderr)
+                self.fail(job['id'], worker_id, message)
+            else:
+                done.set()
+                heartbeat_thread.join()
+                if not self.complete(job['id'], worker_id, stats):
+                    print("%s: job %s (%s) lost its lease before it was completed" % ( worker_id, job['id'], job['input'] ),
+                          file=sys.stderr)
+                    continue
+            processed += 1
+        return processed
+
+    def report(self):
+        """
+        Return a dictionary consolidating the results of all workers.
+        """
+        db = self._connection()
+        states = dict((row['state'], row['cnt'])
+                      for row in db.execute("SELECT state, COUNT(*) AS cnt FROM jobs GROUP BY state"))
+        workers = {}
+        matches = 0
+        slides = 0
+        for row in db.execute("SELECT worker, stats FROM jobs WHERE state='done'"):
+            stats = json.loads(row['stats'])
+            matches += stats.get('matches', 0)
+            slides += stats.get('slides', 0)
+            workers[row['worker']] = workers.get(row['worker'], 0) + 1
+        span = db.execute("SELECT MIN(started) AS first, MAX(finished) AS last FROM jobs WHERE state='done'").fetchone()
+        elapsed = (span['last'] - span['first']) if span['first'] is not None else 0.0
+        failures = [ dict(id=row['id'], input=row['input'], attempts=row['attempts'], error=row['error'])
+                     for row in db.execute("SELECT id, input, attempts, error FROM jobs WHERE state='failed' ORDER BY id") ]
+        return {
+            'jobs': sum(states.values()),
+            'queued': states.get('queued', 0),
+            'running': states.get('running', 0),
+            'done': states.get('done', 0),
+            'failed': states.get('failed', 0),
+            'slides': slides,
+            'matches': matches,
+            'elapsed': elapsed,
+            'jobs_per_minute': 60.0*states.get('done', 0)/elapsed if elapsed > 0 else 0.0,
+            'workers': workers,
+            'failures': failures,
+        }
+
+
+def main(argv):
+    p = argparse.ArgumentParser(prog='python-pptx-text-replacer queue',
+                                description=__doc__,
+                                formatter_class=argparse.RawDescriptionHelpFormatter,
+                                epilog="python-pptx-text-replacer %s" % __version__)
+    p.add_argument('action',
+                   choices=[ 'enqueue', 'work', 'report' ],
+                   help="enqueue the jobs of a manifest, work on the queued jobs or print the consolidated report")
+    p.add_argument('--database', '-d',
+                   action='store',
+                   required=True,
+                   metavar='<database file>',
+                   help="the SQLite database holding the queue (on a filesystem shared by all workers)")
+    p.add_argument('--manifest',
+                   action='store',
+                   required=False,
+                   metavar='<manifest file>',
+                   help="the manifest with one job per line as JSON object (for enqueue)")
+    p.add_argument('--worker-id',
+                   action='store',
+                   required=False,
+                   default=None,
+                   metavar='<worker id>',
+                   help="the name of this worker in the report (default: <host name>-<process id>)")
+    p.add_argument('--lease',
+                   action='store',
+                   type=float,
+                   required=False,
+                   default=60.0,
+                   metavar='<seconds>',
+                   help="seconds a job belongs to a worker without heartbeat (default: 60)")
+    p.add_argument('--max-attempts',
+                   action='store',
+                   type=int,
+                   required=False,
+                   default=3,
+                   metavar='<number>',
+                   help="number of times a job is tried before it is marked as failed (default: 3)")
+    p.add_argument('--verbose','-v',
+                   action='store_const',
+                   dest='verbose',
+                   const=True,
+                   required=False,
+                   default=False,
+                   help="print the jobs processed")
+
+    ns = p.parse_args(argv)
+
+    try:
+        queue = JobQueue(ns.database, lease=ns.lease, max_attempts=ns.max_attempts)
+        if ns.action == 'enqueue':
+            if ns.manifest is None:
+                raise ValueError("enqueue needs a manifest (--manifest).")
+            print("%s jobs enqueued" % ( queue.enqueue_manifest(ns.manifest) ))
+        elif ns.action == 'work':
+            print("%s jobs processed" % ( queue.work(worker_id=ns.worker_id, verbose=ns.verbose) ))
+        else:
+            print(json.dumps(queue.report(), indent=2))
+        return 0
+    except (ValueError, IOError, sqlite3.Error) as err:
+        print(str(err), file=sys.stderr)
+        return 1
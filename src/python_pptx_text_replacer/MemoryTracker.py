@@ -0,0 +1,251 @@
+# -*- encoding: utf-8 -*-
+"""
+This module implements the memory tracking of TextReplacer.
+
+The memory used by a run is tracked per phase (load, traverse, chart rebuild,
+save) as the peak resident set size (RSS) of the process during the phase and how
+far it rose above the RSS at the start of the phase and, optionally, as the peak
+of the allocations traced by tracemalloc. The RSS is sampled by a background
+thread while a phase is running, as the peak RSS the operating system keeps is the
+peak of the whole life of the process. Note that tracemalloc only sees
+allocations done by Python itself, not the ones done by libxml2 for the XML trees,
+which is why the memory budget is checked against the RSS.
+
+Like the RSS, tracemalloc is process-wide: the trackers share the tracing, which
+is running as long as any of them traces a phase. The traced peak of a phase
+includes the allocations of all threads and, while several trackers trace at the
+same time, the peak is not reset at the start of a phase, so it may include peaks
+from before the phase as well.
+"""
+import gc
+import os
+import sys
+import threading
+import tracemalloc
+import zipfile
+
+try:
+    import resource
+except ImportError: # not available on Windows
+    resource = None
+
+# rough number of bytes a parsed XML part takes in memory per byte of XML
+DOM_SIZE_FACTOR = 10
+
+# seconds between two samples of the RSS while a phase is running
+SAMPLE_INTERVAL = 0.02
+
+# tracemalloc is process-wide, so the trackers tracing phases are counted
+_tracing_lock = threading.Lock()
+_tracing_users = 0
+_tracing_started = False
+
+
+def _start_tracing():
+    global _tracing_users, _tracing_started
+    with _tracing_lock:
+        if _tracing_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _tracing_started = True
+        _tracing_users += 1
+
+
+def _stop_tracing():
+    global _tracing_users, _tracing_started
+    with _tracing_lock:
+        _tracing_users -= 1
+        # tracing started by somebody else is left running
+        if _tracing_users == 0 and _tracing_started:
+            tracemalloc.stop()
+            _tracing_started = False
+
+
+def _reset_traced_peak():
+    # resetting the peak would lose the ones of the phases other trackers are tracing
+    with _tracing_lock:
+        if _tracing_users == 1 and hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+
+
+class MemoryBudgetExceeded(MemoryError):
+    """
+    Raised by TextReplacer when processing a presentation exceeds its memory budget.
+    """
+
+
+def current_rss():
+    """
+    Return the current resident set size of the process in bytes or None, if it is unknown.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError, AttributeError):
+        pass
+    if resource is not None:
+        # no current value available, the peak is the best estimate there is
+        return peak_rss()
+    return None
+
+
+def peak_rss():
+    """
+    Return the peak resident set size of the process in bytes or None, if it is unknown.
+    """
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def estimate_presentation_size(file_name):
+    """
+    Return a rough estimate of the bytes it takes to load the presentation file_name.
+    """
+    estimate = 0
+    with zipfile.ZipFile(file_name) as package:
+        for info in package.infolist():
+            if info.filename.endswith(('.xml', '.rels')):
+                estimate += info.file_size * DOM_SIZE_FACTOR
+            else:
+                estimate += info.file_size
+    return estimate
+
+
+class MemoryTracker:
+    """
+    This class records the memory used per phase and checks it against a budget.
+
+    With trace=True the allocations are traced by tracemalloc as well (which slows
+    things down considerably and is process-wide, see above). budget is the number of bytes the RSS may grow
+    beyond what it was when the tracker was created.
+    """
+
+    def __init__(self, trace=False, budget=None):
+        self._trace = trace
+        self._budget = budget
+        self._base_rss = current_rss()
+        self._phases = {}
+        self._stack = []
+        self._lock = threading.Lock()
+        self._sampler = None
+        self._sampler_stop = None
+
+    @property
+    def budget(self):
+        return self._budget
+
+    def check_estimate(self, file_name):
+        if self._budget is None:
+            return
+        estimate = estimate_presentation_size(file_name)
+        if estimate > self._budget:
+            raise MemoryBudgetExceeded("Loading presentation %s is estimated to take %s MB, "
+                                       "which exceeds the memory budget of %s MB."
+                                       % ( file_name, estimate // 2**20, self._budget // 2**20 ))
+
+    def used(self):
+        """
+        Return the bytes the RSS grew since the tracker was created or None, if unknown.
+        """
+        rss = current_rss()
+        if rss is None or self._base_rss is None:
+            return None
+        return max(0, rss - self._base_rss)
+
+    def is_pressing(self):
+        """
+        Return True, if more than three quarters of the budget are used up.
+        """
+        if self._budget is None:
+            return False
+        used = self.used()
+        return used is not None and used > self._budget * 3 // 4
+
+    def sample(self):
+        """
+        Record the current RSS as a sample of all running phases.
+        """
+        rss = current_rss()
+        if rss is None:
+            return
+        with self._lock:
+            for entry in self._stack:
+                entry['peak_rss'] = max(entry['peak_rss'] or 0, rss)
+
+    def _sample_until_stopped(self, stop):
+        while not stop.wait(SAMPLE_INTERVAL):
+            self.sample()
+
+    def check(self, what):
+        self.sample()
+        if self._budget is None:
+            return
+        used = self.used()
+        if used is not None and used > self._budget:
+            gc.collect()
+            used = self.used()
+            if used is not None and used > self._budget:
+                raise MemoryBudgetExceeded("%s uses %s MB, which exceeds the memory budget of %s MB."
+                                           % ( what, used // 2**20, self._budget // 2**20 ))
+
+    def start(self, phase):
+        if self._trace:
+            if not self._stack:
+                _start_tracing()
+            peak = tracemalloc.get_traced_memory()[1]
+            if self._stack:
+                # the nested phase resets the peak, so remember the one of the enclosing phase
+                self._stack[-1]['peak_traced'] = max(self._stack[-1]['peak_traced'], peak)
+            _reset_traced_peak()
+        rss = current_rss()
+        with self._lock:
+            self._stack.append({ 'phase': phase, 'peak_traced': 0, 'start_rss': rss, 'peak_rss': rss })
+        if self._sampler is None and rss is not None:
+            self._sampler_stop = threading.Event()
+            self._sampler = threading.Thread(target=self._sample_until_stopped, args=( self._sampler_stop, ))
+            self._sampler.daemon = True
+            self._sampler.start()
+
+    def stop(self):
+        self.sample()
+        with self._lock:
+            entry = self._stack.pop()
+        if not self._stack and self._sampler is not None:
+            self._sampler_stop.set()
+            self._sampler.join()
+            self._sampler = None
+        stats = self._phases.setdefault(entry['phase'], { 'peak_rss': None, 'peak_rss_increase': None, 'peak_traced': None })
+        if entry['peak_rss'] is not None:
+            stats['peak_rss'] = max(stats['peak_rss'] or 0, entry['peak_rss'])
+            stats['peak_rss_increase'] = max(stats['peak_rss_increase'] or 0, entry['peak_rss'] - entry['start_rss'])
+        if self._trace:
+            peak = max(entry['peak_traced'], tracemalloc.get_traced_memory()[1])
+            stats['peak_traced'] = max(stats['peak_traced'] or 0, peak)
+            if self._stack:
+                self._stack[-1]['peak_traced'] = max(self._stack[-1]['peak_traced'], peak)
+            else:
+                _stop_tracing()
+
+    def get_stats(self):
+        return dict((phase, dict(stats)) for phase, stats in self._phases.items())
+
+
+class MemoryPhase:
+    """
+    Context manager recording the memory used in a phase with a MemoryTracker.
+    """
+
+    def __init__(self, tracker, phase):
+        self._tracker = tracker
+        self._phase = phase
+
+    def __enter__(self):
+        if self._tracker is not None:
+            self._tracker.start(self._phase)
+        return self
+
+    def __exit__(self, *args):
+        if self._tracker is not None:
+            self._tracker.stop()
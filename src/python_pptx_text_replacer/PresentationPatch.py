@@ -0,0 +1,215 @@
+# -*- encoding: utf-8 -*-
+"""
+This module implements patches holding only the changed parts of a presentation.
+
+Text replacement usually changes only a few slides of a presentation. Instead of
+storing a full copy of the changed presentation, a patch stores just the changed
+package parts plus a manifest with the hash of the original presentation file and
+the hashes of the parts. The changed presentation is rebuilt from the original
+file and the patch, copying all unchanged zip members raw, without decompressing
+and compressing them again.
+"""
+from __future__ import print_function, unicode_literals
+
+import argparse
+import copy
+import hashlib
+import json
+import posixpath
+import struct
+import sys
+import zipfile
+
+from lxml import etree
+
+from .TextReplacer import __version__, _write_file_atomically
+
+PATCH_FORMAT = 1
+MANIFEST_NAME = 'manifest.json'
+PARTS_DIR = 'parts/'
+
+# parses like python-pptx does, which drops the whitespace between elements
+_XML_PARSER = etree.XMLParser(remove_blank_text=True, resolve_entities=False)
+
+
+def _sha256_of_file(file_name):
+    sha256 = hashlib.sha256()
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def _rels_member_name(member_name):
+    # the relationships of /ppt/slides/slide1.xml live in /ppt/slides/_rels/slide1.xml.rels
+    directory, _, name = member_name.rpartition('/')
+    return "%s_rels/%s.rels" % ( directory + '/' if directory else '', name )
+
+
+def _canonical_xml(name, data):
+    root = etree.fromstring(data, _XML_PARSER)
+    if name.endswith('.rels'):
+        # python-pptx writes the relationships in its own order and with targets
+        # relative to the part, so compare where they point to
+        base = posixpath.dirname(posixpath.dirname(name))
+        return frozenset(( rel.get('Id'), rel.get('Type'), rel.get('TargetMode'),
+                           rel.get('Target') if rel.get('TargetMode') == 'External'
+                           else posixpath.normpath(posixpath.join('/' + base, rel.get('Target'))) )
+                         for rel in root)
+    if name == '[Content_Types].xml':
+        return frozenset(( etree.QName(entry).localname, (entry.get('Extension') or entry.get('PartName')).lower(),
+                           entry.get('ContentType') )
+                         for entry in root)
+    return etree.tostring(root, method='c14n')
+
+
+def _is_same_member(source, target, name):
+    try:
+        source_info = source.getinfo(name)
+    except KeyError:
+        return False
+    target_info = target.getinfo(name)
+    if source_info.file_size == target_info.file_size and source_info.CRC == target_info.CRC \
+       and source.read(name) == target.read(name):
+        return True
+    if not name.endswith(('.xml', '.rels')):
+        return False
+    # python-pptx serializes every XML part it parsed, even unchanged ones, in its own way
+    try:
+        return _canonical_xml(name, source.read(name)) == _canonical_xml(name, target.read(name))
+    except (etree.XMLSyntaxError, AttributeError, TypeError):
+        return False
+
+
+def write_patch(source_file_name, presentation_stream, changed_partnames, patch_file_name):
+    """
+    Write a patch for the saved presentation in presentation_stream to patch_file_name.
+
+    changed_partnames are the names of the parts (like '/ppt/slides/slide1.xml'),
+    that are known to have been changed compared to the original presentation file
+    source_file_name. All other members of the saved presentation are compared with
+    the member of the same name in the original file, because python-pptx changes
+    more than the edited parts - it renames the slide parts of a presentation, whose
+    slides have been reordered, for example. Added members are included as well.
+    """
+    presentation_stream.seek(0)
+    with zipfile.ZipFile(source_file_name) as source, zipfile.ZipFile(presentation_stream) as target:
+        source_names = set(source.namelist())
+        target_names = target.namelist()
+        changed = set(partname.lstrip('/') for partname in changed_partnames)
+        # the relationships of changed parts may have changed along with them
+        changed |= set(_rels_member_name(name) for name in changed)
+        changed &= set(target_names)
+        for name in target_names:
+            if name not in changed and not _is_same_member(source, target, name):
+                changed.add(name)
+
+        manifest = {
+            'format': PATCH_FORMAT,
+            'generator': "python-pptx-text-replacer %s" % __version__,
+            'source': {
+                'sha256': _sha256_of_file(source_file_name),
+            },
+            'members': target_names,
+            'removed': sorted(source_names - set(target_names)),
+            'changed': {},
+        }
+
+        def write(f):
+            with zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED) as patch:
+                for name in target_names:
+                    if name not in changed:
+                        continue
+                    data = target.read(name)
+                    manifest['changed'][name] = hashlib.sha256(data).hexdigest()
+                    patch.writestr(PARTS_DIR + name, data)
+                patch.writestr(MANIFEST_NAME, json.dumps(manifest, indent=2))
+        _write_file_atomically(patch_file_name, write)
+    return manifest
+
+
+def _copy_member_raw(source, info, target):
+    # Copy the compressed data of the member as it is. zipfile has no public API for
+    # this, so the local file header is written here and the member registered with
+    # the target, just like ZipFile.write does it.
+    source.fp.seek(info.header_offset)
+    header = source.fp.read(zipfile.sizeFileHeader)
+    if len(header) != zipfile.sizeFileHeader or header[0:4] != zipfile.stringFileHeader:
+        raise ValueError("Member %s of the original presentation is corrupt." % ( info.filename ))
+    name_len, extra_len = struct.unpack('<HH', header[26:30])
+    source.fp.seek(info.header_offset + zipfile.sizeFileHeader + name_len + extra_len)
+    target_info = copy.copy(info)
+    target_info.flag_bits &= ~0x08 # the sizes are in the local header, there is no data descriptor
+    target_info.header_offset = target.fp.tell()
+    target.fp.write(target_info.FileHeader())
+    remaining = info.compress_size
+    while remaining > 0:
+        chunk = source.fp.read(min(remaining, 1 << 20))
+        if not chunk:
+            raise ValueError("Member %s of the original presentation is truncated." % ( info.filename ))
+        target.fp.write(chunk)
+        remaining -= len(chunk)
+    target.filelist.append(target_info)
+    target.NameToInfo[target_info.filename] = target_info
+    target.start_dir = target.fp.tell()
+    target._didModify = True
+
+
+def apply_patch(source_file_name, patch_file_name, output_file_name):
+    """
+    Rebuild the changed presentation from the original presentation file
+    source_file_name and the patch patch_file_name and write it to output_file_name.
+    """
+    with zipfile.ZipFile(patch_file_name) as patch:
+        try:
+            manifest = json.loads(patch.read(MANIFEST_NAME).decode('utf-8'))
+        except KeyError:
+            raise ValueError("Patch %s has no manifest." % ( patch_file_name ))
+        if manifest.get('format') != PATCH_FORMAT:
+            raise ValueError("Patch %s has the unsupported format %s." % ( patch_file_name, manifest.get('format') ))
+        if _sha256_of_file(source_file_name) != manifest['source']['sha256']:
+            raise ValueError("Patch %s doesn't belong to presentation %s." % ( patch_file_name, source_file_name ))
+
+        with zipfile.ZipFile(source_file_name) as source:
+            def write(f):
+                with zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED) as target:
+                    for name in manifest['members']:
+                        if name in manifest['changed']:
+                            data = patch.read(PARTS_DIR + name)
+                            if hashlib.sha256(data).hexdigest() != manifest['changed'][name]:
+                                raise ValueError("Part %s in patch %s is corrupt." % ( name, patch_file_name ))
+                            target.writestr(name, data)
+                        else:
+                            _copy_member_raw(source, source.getinfo(name), target)
+            _write_file_atomically(output_file_name, write)
+
+
+def main(argv):
+    p = argparse.ArgumentParser(prog='python-pptx-text-replacer apply-patch',
+                                description=__doc__,
+                                formatter_class=argparse.RawDescriptionHelpFormatter,
+                                epilog="python-pptx-text-replacer %s" % __version__)
+    p.add_argument('--input',   '-i',
+                   action='store',
+                   required=True,
+                   metavar='<input file>',
+                   help="the original presentation the patch was made for")
+    p.add_argument('--patch',   '-p',
+                   action='store',
+                   required=True,
+                   metavar='<patch file>',
+                   help="the patch to apply")
+    p.add_argument('--output',  '-o',
+                   action='store',
+                   required=True,
+                   metavar='<output file>',
+                   help="the file to write the changed presentation to")
+
+    ns = p.parse_args(argv)
+
+    try:
+        apply_patch(ns.input, ns.patch, ns.output)
+        return 0
+    except (ValueError, KeyError, IOError, zipfile.BadZipfile) as err:
+        print(str(err), file=sys.stderr)
+        return 1
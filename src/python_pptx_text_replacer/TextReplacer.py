@@ -14,11 +14,18 @@ or it can be called as main and given parameters to define what needs to be done
 """
 from __future__ import print_function, unicode_literals
 
+import io
 import os
 import sys
 import argparse
 import re
+import hashlib
+import posixpath
+import signal
+import threading
+import time
 import unicodedata
+import zipfile
 
 if sys.version_info[0]==3:
     PY2 = False
@@ -27,6 +34,7 @@ if sys.version_info[0]==3:
 else:
     PY2 = True
 
+import pptx.opc.package
 from pptx import Presentation
 from pptx.dml.color import RGBColor
 from pptx.chart.data import CategoryChartData
@@ -34,10 +42,147 @@ from pptx.shapes.graphfrm import GraphicFrame
 from pptx.enum.chart import XL_CHART_TYPE
 from pptx.enum.shapes import MSO_SHAPE_TYPE
 from pptx.enum.dml import MSO_COLOR_TYPE
+from pptx.opc.constants import RELATIONSHIP_TYPE as RT
+from pptx.opc.package import Part
+from pptx.oxml import parse_xml
+from pptx.oxml.ns import qn
+from pptx.table import _Cell
 from pptx.util import Inches
 
+from .MemoryTracker import MemoryTracker, MemoryPhase, MemoryBudgetExceeded
+
 __version__ = "v0.0.6"
 
+def _write_file_atomically(file_name, write):
+    # Call write with a temporary file next to file_name and rename it afterwards,
+    # so an interrupted write never leaves a half-written file behind.
+    file_name = os.path.abspath(file_name)
+    tmp_file_name = os.path.join(os.path.dirname(file_name),
+                                 ".%s.%s-%s.tmp" % ( os.path.basename(file_name), os.getpid(), threading.get_ident() ))
+    try:
+        with open(tmp_file_name, 'wb') as f:
+            write(f)
+        os.replace(tmp_file_name, file_name)
+    except BaseException:
+        if os.path.exists(tmp_file_name):
+            os.unlink(tmp_file_name)
+        raise
+
+
+_PartFactory = pptx.opc.package.PartFactory
+_unparsed_parts = threading.local()
+_unparsed_parts_lock = threading.Lock()
+_unparsed_parts_users = 0
+
+
+class _SelectivePartFactory(object):
+    # Stands in for python-pptx's PartFactory while a presentation is loaded with
+    # _UnparsedParts. Parts named in the set of the loading thread are loaded as plain
+    # parts, that just keep their blob. All other parts are handed to PartFactory.
+    # The argument order of PartFactory and Part.load is the one of python-pptx 1.0,
+    # which is why pyproject.toml requires python-pptx>=1.0.
+    def __new__(cls, partname, content_type, package, blob):
+        if partname in getattr(_unparsed_parts, 'partnames', ()):
+            return Part.load(partname, content_type, package, blob)
+        return _PartFactory(partname, content_type, package, blob)
+
+
+class _UnparsedParts(object):
+    # Context manager loading the parts with the names in partnames unparsed,
+    # if a presentation is loaded in the current thread.
+
+    def __init__(self, partnames):
+        self._partnames = partnames
+
+    def __enter__(self):
+        global _unparsed_parts_users
+        with _unparsed_parts_lock:
+            if _unparsed_parts_users == 0:
+                pptx.opc.package.PartFactory = _SelectivePartFactory
+            _unparsed_parts_users += 1
+        _unparsed_parts.partnames = self._partnames
+        return self
+
+    def __exit__(self, *args):
+        global _unparsed_parts_users
+        _unparsed_parts.partnames = ()
+        with _unparsed_parts_lock:
+            _unparsed_parts_users -= 1
+            if _unparsed_parts_users == 0:
+                pptx.opc.package.PartFactory = _PartFactory
+
+
+class ReplacementCancelled(Exception):
+    """
+    Raised by TextReplacer.replace_text when its cancellation token has been cancelled.
+
+    The presentation is left partially changed and shouldn't be saved.
+    """
+
+
+class CancellationToken:
+    """
+    This class is used to cancel a running TextReplacer.replace_text from the outside.
+
+    The token is checked between slides and shapes, so cancel() can be called from
+    another thread or a signal handler. A token with a parent token is cancelled
+    as well, when its parent is cancelled.
+    """
+
+    def __init__(self, parent=None):
+        self._cancelled = False
+        self._parent = parent
+
+    def cancel(self):
+        self._cancelled = True
+
+    @property
+    def cancelled(self):
+        return self._cancelled or (self._parent is not None and self._parent.cancelled)
+
+
+class SlideMasterCache:
+    """
+    This class caches the edited XML of slide masters across TextReplacer instances.
+
+    Decks created from the same template share byte-identical slide masters. Passed
+    to TextReplacer.replace_text as master_cache, the edited XML of a slide master is
+    stored (along with the number of matches and the changes of the runs) under the
+    hash of its original XML and the replacements done, and every later deck with the
+    same slide master gets the stored result instead of having it traversed and
+    edited again.
+    At most max_entries results are kept, the least recently used ones are dropped.
+    """
+
+    def __init__(self, max_entries=64):
+        self._max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+            else:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            return entry
+
+    def put(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
 class TextReplacer:
     """
     This class implements text replacement in Powerpoint files in pptx format.
@@ -50,56 +195,119 @@ class TextReplacer:
                  textframes=True,
                  slides='',
                  verbose=False,
-                 quiet=False):
+                 quiet=False,
+                 track_memory=False,
+                 memory_budget=None,
+                 edit_plan_cache_size=1024):
         self._messages = []
         self._replacements = []
         self._collected_replacements = []
         self._presentation_file_name = self._ensure_unicode(presentation_file_name)
         if not os.path.exists(self._presentation_file_name):
             raise ValueError("Presentation file %s does not exist." % ( self._presentation_file_name ))
-        self._presentation = Presentation(presentation_file_name)
+        if track_memory or memory_budget is not None:
+            self._memory = MemoryTracker(trace=track_memory, budget=memory_budget)
+            self._memory.check_estimate(self._presentation_file_name)
+        else:
+            self._memory = None
+        self._low_memory = False
+        if len(slides.strip())==0:
+            with MemoryPhase(self._memory, 'load'):
+                self._presentation = Presentation(presentation_file_name)
+            self._slides = [ True ] * len(self._presentation.slides)
+        else:
+            # Push the slide selection down into loading: the slides not selected
+            # (and their charts and notes) are loaded as plain parts, whose XML is
+            # never parsed and is written back untouched.
+            slide_parts = self._scan_slide_parts()
+            self._slides = self._parse_slide_list(slides, len(slide_parts))
+            unparsed = set()
+            parsed = set()
+            for selected, (partname, related) in zip(self._slides, slide_parts):
+                (parsed if selected else unparsed).update([ partname ] + related)
+            with MemoryPhase(self._memory, 'load'), _UnparsedParts(unparsed - parsed):
+                self._presentation = Presentation(presentation_file_name)
+        if self._memory is not None:
+            self._memory.check("Loading presentation %s" % ( self._presentation_file_name ))
         self._tables = tables
         self._charts = charts
         self._textframes = textframes
         self._default_verbose = verbose
         self._default_quiet = quiet
         self._current_slide_idx = 0
-        slide_cnt = len(self._presentation.slides)
-        if len(slides.strip())==0:
-            self._slides = [ True ] * slide_cnt
-        else:
-            self._slides = [ False ] * slide_cnt
-            for rr in re.split('\\s*,\\s*',slides.strip()):
-                r = re.split('\\s*-\\s*',rr,maxsplit=3)
-                low = None
-                high = None
-                if len(r)<=2:
-                    try:
-                        low = int(r[0])
-                    except:
-                        low = None
-                    high = low
-                    if len(r)==2:
-                        if len(r[1])==0:
-                            high = slide_cnt
-                        else:
-                            try:
-                                high = int(r[1])
-                            except:
-                                high = None
-                if low is None or high is None:
-                    raise ValueError('Slide list (--slides "%s") is not a comma separated list of slide numbers (i.e. 1) or slide number ranges (i.e. 4-12)' % (slides))
-                if low<1 or low>slide_cnt:
-                    raise ValueError('Slide number %s in list (--slides "%s") is lower than 1 or bigger than the last slide number %s' % ( low, slides, slide_cnt ))
-                if high<1 or high>slide_cnt:
-                    raise ValueError('Slide number %s in list (--slides "%s") is lower than 1 or bigger than the last slide number %s' % ( high, slides, slide_cnt ))
-                if low > high:
-                    raise ValueError('Slide range %s in list (--slides "%s") is invalid.' % ( r, slides ))
-                for i in range(low-1,high):
-                    self._slides[i] = True
-
-
-    def replace_text(self, replacements, use_regex=False, verbose=None, quiet=None, edit_slide_master=True):
+        self._text_containers = {}
+        self._changed_parts = set()
+        self._edit_plans = collections.OrderedDict()
+        self._edit_plan_cache_size = edit_plan_cache_size
+        self._run_stats = {}
+        self._progress = None
+        self._cancellation_token = None
+
+    def _parse_slide_list(self, slides, slide_cnt):
+        selected = [ False ] * slide_cnt
+        for rr in re.split('\\s*,\\s*',slides.strip()):
+            r = re.split('\\s*-\\s*',rr,maxsplit=3)
+            low = None
+            high = None
+            if len(r)<=2:
+                try:
+                    low = int(r[0])
+                except:
+                    low = None
+                high = low
+                if len(r)==2:
+                    if len(r[1])==0:
+                        high = slide_cnt
+                    else:
+                        try:
+                            high = int(r[1])
+                        except:
+                            high = None
+            if low is None or high is None:
+                raise ValueError('Slide list (--slides "%s") is not a comma separated list of slide numbers (i.e. 1) or slide number ranges (i.e. 4-12)' % (slides))
+            if low<1 or low>slide_cnt:
+                raise ValueError('Slide number %s in list (--slides "%s") is lower than 1 or bigger than the last slide number %s' % ( low, slides, slide_cnt ))
+            if high<1 or high>slide_cnt:
+                raise ValueError('Slide number %s in list (--slides "%s") is lower than 1 or bigger than the last slide number %s' % ( high, slides, slide_cnt ))
+            if low > high:
+                raise ValueError('Slide range %s in list (--slides "%s") is invalid.' % ( r, slides ))
+            for i in range(low-1,high):
+                selected[i] = True
+        return selected
+
+    def _scan_slide_parts(self):
+        # Return the names of the slide parts in presentation order, each with the names
+        # of the charts and notes related to it, by reading only the relationships and
+        # the list of slides from the package.
+        with zipfile.ZipFile(self._presentation_file_name) as package:
+            def related_parts(partname):
+                rels_name = posixpath.join(posixpath.dirname(partname), '_rels', posixpath.basename(partname)+'.rels')
+                try:
+                    rels_xml = parse_xml(package.read(rels_name.lstrip('/')))
+                except KeyError:
+                    return {}
+                related = {}
+                for rel in rels_xml.iterchildren(qn('pr:Relationship')):
+                    if rel.get('TargetMode') == 'External':
+                        continue
+                    target = posixpath.normpath(posixpath.join(posixpath.dirname(partname), rel.get('Target')))
+                    related[rel.get('Id')] = ( rel.get('Type'), target )
+                return related
+
+            presentation_partname = [ target for (reltype, target) in related_parts('/').values()
+                                      if reltype == RT.OFFICE_DOCUMENT ][0]
+            presentation_rels = related_parts(presentation_partname)
+            presentation_xml = parse_xml(package.read(presentation_partname.lstrip('/')))
+            slide_parts = []
+            for sldId in presentation_xml.iter(qn('p:sldId')):
+                slide_partname = presentation_rels[sldId.get(qn('r:id'))][1]
+                related = [ target for (reltype, target) in related_parts(slide_partname).values()
+                            if reltype in ( RT.CHART, RT.NOTES_SLIDE ) ]
+                slide_parts.append(( slide_partname, related ))
+            return slide_parts
+
+    def replace_text(self, replacements, use_regex=False, verbose=None, quiet=None, edit_slide_master=True, master_cache=None,
+                     progress=None, cancellation_token=None):
         import sys
 
         # Ensure all replacements are unicode
@@ -109,6 +317,9 @@ class TextReplacer:
         ]
         self._collected_replacements.extend(replacements)
         self._use_regex = use_regex
+        self._edit_plan_key = ( tuple(self._replacements), use_regex )
+        self._edit_plan = None
+        self._master_changes = None
 
         # Set verbosity and quietness
         self._verbose = self._default_verbose if verbose is None else bool(verbose)
@@ -142,41 +353,82 @@ class TextReplacer:
                                 f"match/replacement ('{srch_i}', '{repl_i}') at index {i}."
                             )
 
-        def process_slides(slides, slide_type="slide"):
-            for idx, slide in enumerate(slides):
-                if self._verbose:
-                    title = slide.shapes.title.text if slide.shapes.title else "<no title>"
-                    print(f"  {slide_type.capitalize()}[{idx + 1}, id={slide.slide_id}] with title '{title}'")
-
-                # For slides, check if the slide should be processed
-                if slide_type == "slide":
-                    if not self._slides[idx]:
-                        if self._verbose:
-                            print("    ... skipped")
-                        continue
-
-                # Process shapes in the slide
-                self._process_shapes(2, slide)
+        self._progress = progress
+        self._cancellation_token = cancellation_token
+        slide_count = len(self._presentation.slides)
+        if edit_slide_master:
+            slide_count += len(self._presentation.slide_masters)
+        self._run_stats = {
+            'slides': 0,
+            'slide_count': slide_count,
+            'matches': 0,
+            'edit_plans_reused': 0,
+            'elapsed': 0.0,
+        }
+        self._start_time = time.time()
 
         if self._verbose:
             print(f"Presentation[{self._presentation_file_name}]")
 
-        # Process presentation slides
-        process_slides(self._presentation.slides, slide_type="slide")
+        try:
+            with MemoryPhase(self._memory, 'traverse'):
+                # Process presentation slides
+                self._process_text_containers(self._get_text_containers("slide"))
 
-        # Process slide masters if edit_slide_master is True
-        if edit_slide_master:
-            process_slides(self._presentation.slide_masters, slide_type="slide master")
+                # Process slide masters if edit_slide_master is True
+                if edit_slide_master:
+                    if master_cache is None:
+                        self._process_text_containers(self._get_text_containers("slide master"))
+                    else:
+                        self._process_slide_masters_with_cache(master_cache)
+        finally:
+            self._run_stats['elapsed'] = time.time() - self._start_time
 
-        # Print collected messages
-        if self._messages:
-            print("The following warnings and errors have been issued during this run:", file=sys.stderr)
-            for msg in self._messages:
-                print(msg, file=sys.stderr)
+            # Print collected messages
+            if self._messages:
+                print("The following warnings and errors have been issued during this run:", file=sys.stderr)
+                for msg in self._messages:
+                    print(msg, file=sys.stderr)
 
 
     def write_presentation_to_file(self, presentation_output_file_name):
-        self._presentation.save(presentation_output_file_name)
+        with MemoryPhase(self._memory, 'save'):
+            if not hasattr(presentation_output_file_name, 'write') and \
+               (not os.path.exists(presentation_output_file_name) or os.path.isfile(presentation_output_file_name)):
+                _write_file_atomically(presentation_output_file_name, self._presentation.save)
+            else:
+                self._presentation.save(presentation_output_file_name)
+
+    def write_presentation_patch(self, patch_file_name):
+        """
+        Write a patch with the parts of the presentation differing from the original file to patch_file_name.
+
+        The patch holds those parts and a manifest with the hash of the original
+        presentation file and the hashes of the parts. Use apply_patch from module
+        PresentationPatch (or the command apply-patch) to rebuild the changed presentation
+        from the original presentation file and the patch.
+        """
+        from .PresentationPatch import write_patch
+        with MemoryPhase(self._memory, 'save'):
+            stream = io.BytesIO()
+            self._presentation.save(stream)
+            write_patch(self._presentation_file_name, stream,
+                        set(str(part.partname) for part in self._changed_parts),
+                        patch_file_name)
+
+    def get_run_stats(self):
+        """
+        Return the statistics of the last call to replace_text as dictionary with
+        the slides processed so far, the number of slides (including slide masters,
+        if they are edited), the number of matches and the elapsed seconds.
+        If memory is tracked, 'memory' holds the peak RSS during the phase, how far the
+        RSS rose above the one at the start of the phase and the peak traced allocations
+        (in bytes) per phase (load, traverse, chart rebuild and save).
+        """
+        stats = dict(self._run_stats)
+        if self._memory is not None:
+            stats['memory'] = self._memory.get_stats()
+        return stats
 
     def get_replacements(self):
         return self._collected_replacements
@@ -206,7 +458,45 @@ class TextReplacer:
 
 
     def _replace_text_in_text_frame(self, level, shape, text_frame):
-        
+        # Footers, disclaimers and labels repeat the same text frame over and over. What
+        # the replacements do to a text frame only depends on the texts of its runs per
+        # paragraph, so the resulting run texts (the edit plan) are memoized under them.
+        if self._verbose or self._edit_plan_cache_size <= 0:
+            self._find_and_replace_in_text_frame(level, shape, text_frame)
+            return
+        runs = [ paragraph.runs for paragraph in text_frame.paragraphs ]
+        key = ( tuple(tuple(self._ensure_unicode(run.text) for run in paragraph_runs) for paragraph_runs in runs),
+                self._edit_plan_key )
+        plan = self._edit_plans.get(key)
+        if plan is None:
+            matches = self._run_stats['matches']
+            self._edit_plan = []
+            try:
+                self._find_and_replace_in_text_frame(level, shape, text_frame)
+                plan = ( self._edit_plan, self._run_stats['matches'] - matches )
+            finally:
+                self._edit_plan = None
+            self._edit_plans[key] = plan
+            while len(self._edit_plans) > self._edit_plan_cache_size:
+                self._edit_plans.popitem(last=False)
+        else:
+            self._edit_plans.move_to_end(key)
+            (edits, match_cnt) = plan
+            self._run_stats['matches'] += match_cnt
+            self._run_stats['edit_plans_reused'] += 1
+            final_texts = collections.OrderedDict()
+            for (paragraph_idx, run_idx, otext, ntext) in edits:
+                self._run_changed(shape, paragraph_idx, run_idx, otext, ntext)
+                final_texts[( paragraph_idx, run_idx )] = ntext
+            for (paragraph_idx, run_idx), ntext in final_texts.items():
+                run = runs[paragraph_idx][run_idx]
+                saved_font = self._save_font_configuration(run.font)
+                run.text = ntext
+                self._restore_font_configuration(saved_font, run.font)
+            if len(final_texts) > 0:
+                self._changed_parts.add(shape.part)
+
+    def _find_and_replace_in_text_frame(self, level, shape, text_frame):
         for (srch, replacement) in self._replacements:
             text = "\n".join("".join(self._ensure_unicode(run.text) for run in par.runs) for par in text_frame.paragraphs)
             if self._use_regex:
@@ -226,6 +516,7 @@ class TextReplacer:
                 if self._verbose:
                     print("%sTrying to match '%s' -> no match" % ( "  "*level, srch ))
             while pos_in_text_frame>=0:
+                self._run_stats['matches'] += 1
                 if self._verbose:
                     print("%sTrying to match '%s' -> matched at %s%s" %
                           ( "  "*level,
@@ -298,6 +589,30 @@ class TextReplacer:
         # font.language_id = saved['language_id']
 
 
+    def _set_run_text(self, level, shape, paragraph_idx, run_idx, run, otext, ntext):
+        saved_font = self._save_font_configuration(run.font)
+        run.text = ntext
+        self._changed_parts.add(shape.part)
+        self._restore_font_configuration(saved_font, run.font)
+        if self._verbose:
+            print("%sRun[%s,%s]: '%s' -> '%s'" % ( "  "*level, paragraph_idx, run_idx, otext, ntext ))
+        self._run_changed(shape, paragraph_idx, run_idx, otext, ntext)
+        if self._edit_plan is not None:
+            self._edit_plan.append(( paragraph_idx, run_idx, otext, ntext ))
+
+    def _run_changed(self, shape, paragraph_idx, run_idx, otext, ntext):
+        change = ( str(shape.shape_type)[0:str(shape.shape_type).find(' ')], shape.shape_id, paragraph_idx, run_idx, otext, ntext )
+        if self._master_changes is not None:
+            # remembered along with the edited slide master in the SlideMasterCache
+            self._master_changes.append(change)
+        if not self._verbose:
+            self._print_run_change(*change)
+
+    def _print_run_change(self, shape_type, shape_id, paragraph_idx, run_idx, otext, ntext):
+        if not self._quiet:
+            print("Slide[%s].%s[id=%s].Run[%s,%s]: '%s' -> '%s'"
+                    % (self._current_slide_idx+1, shape_type, shape_id, paragraph_idx, run_idx, otext, ntext))
+
     def _replace_runs_text(self, level, shape, paragraph_idx, runs, pos, srch, replacement):
         cnt = len(runs)
         i = 0
@@ -320,26 +635,12 @@ class TextReplacer:
                     if pos+match_len < olen:
                         # our match ends before the end of the text of this run therefore
                         # we put the rest of our replacement string here and we are done!
-                        saved_font = self._save_font_configuration(run.font)
-                        run.text = otext[0:pos]+to_replace+otext[pos+match_len:]
-                        self._restore_font_configuration(saved_font, run.font)
-                        if self._verbose:
-                            print("%sRun[%s,%s]: '%s' -> '%s'" % ( "  "*level, paragraph_idx, i, otext, run.text ))
-                        elif not self._quiet:
-                            print("Slide[%s].%s[id=%s].Run[%s,%s]: '%s' -> '%s'"
-                                    % (self._current_slide_idx+1, str(shape.shape_type)[0:str(shape.shape_type).find(' ')], shape.shape_id, paragraph_idx, i, otext, run.text))
+                        self._set_run_text(level, shape, paragraph_idx, i, run, otext, otext[0:pos]+to_replace+otext[pos+match_len:])
                         return ('','')
                     if pos+match_len == olen:
                         # our match ends together with the text of this run therefore
                         # we put the rest of our replacement string here and we are done!
-                        saved_font = self._save_font_configuration(run.font)
-                        run.text = otext[0:pos]+to_replace
-                        self._restore_font_configuration(saved_font, run.font)
-                        if self._verbose:
-                            print("%sRun[%s,%s]: '%s' -> '%s'" % ( "  "*level, paragraph_idx, i, otext, run.text ))
-                        elif not self._quiet:
-                            print("Slide[%s].%s[id=%s].Run[%s,%s]: '%s' -> '%s'"
-                                    % (self._current_slide_idx+1, str(shape.shape_type)[0:str(shape.shape_type).find(' ')], shape.shape_id, paragraph_idx, i, otext, run.text))
+                        self._set_run_text(level, shape, paragraph_idx, i, run, otext, otext[0:pos]+to_replace)
                         return ('','')
                     # we still haven't found all of our original match string
                     # so we process what we have here and go on to the next run
@@ -360,14 +661,7 @@ class TextReplacer:
                         ntext += to_replace[0:part_match_len]
                         to_replace = to_replace[part_match_len:]
                         repl_len -= part_match_len
-                    if self._verbose:
-                        print("%sRun[%s,%s]: '%s' -> '%s'" % ( "  "*level, paragraph_idx, i, otext, ntext ))
-                    elif not self._quiet:
-                        print("Slide[%s].%s[id=%s].Run[%s,%s]: '%s' -> '%s'"
-                                % (self._current_slide_idx+1, str(shape.shape_type)[0:str(shape.shape_type).find(' ')], shape.shape_id, paragraph_idx, i, otext, ntext))
-                    saved_font = self._save_font_configuration(run.font)
-                    run.text = ntext            # save the new text to the run
-                    self._restore_font_configuration(saved_font, run.font)
+                    self._set_run_text(level, shape, paragraph_idx, i, run, otext, ntext)
                     to_match = to_match[part_match_len:] # this is what is left to match
                     match_len -= part_match_len # this is the length of the match that is left
                     pos = 0                     # in the next run, we start at pos 0 with our match
@@ -402,92 +696,244 @@ class TextReplacer:
                 paragraph_idx += 1
         self._replace_text_in_text_frame(level+1, shape, text_frame)
 
-    def _process_shapes(self, level, shape_list_parent):
-        for shape in shape_list_parent.shapes:
-            if self._verbose:
-                print("%sShape[%s, id=%s, type=%s]" % ( "  "*level, shape_list_parent.shapes.index(shape), shape.shape_id, shape.shape_type ))
+    def _get_text_containers(self, slide_type):
+        # The flat index of everything that holds text is built on first use and
+        # reused by all later calls to replace_text. Only structural changes (like
+        # rebuilding a chart) throw it away again. In low memory mode there is no
+        # index at all, the containers of one slide after the other are produced
+        # while they are processed.
+        if self._low_memory:
+            return ( container for slide_containers in self._index_slides(slide_type) for container in slide_containers )
+        containers = self._text_containers.get(slide_type)
+        if containers is None:
+            containers = [ container for slide_containers in self._index_slides(slide_type) for container in slide_containers ]
+            self._text_containers[slide_type] = containers
+        return containers
+
+    def _index_slides(self, slide_type):
+        # yields the list of text containers of every slide
+        if slide_type == "slide":
+            presentation_part = self._presentation.part
+            for idx, sldId in enumerate(self._presentation.slides._sldIdLst.sldId_lst):
+                # Slides not selected for processing haven't even been parsed
+                if not self._slides[idx]:
+                    yield [ ('unloaded slide', idx, sldId.id, slide_type), ('skipped', 2) ]
+                else:
+                    slide = presentation_part.related_slide(sldId.rId)
+                    containers = [ ('slide', idx, slide, slide_type) ]
+                    self._index_shapes(containers, 2, slide)
+                    yield containers
+        else:
+            for idx, slide in enumerate(self._presentation.slide_masters):
+                containers = [ ('slide', idx, slide, slide_type) ]
+                self._index_shapes(containers, 2, slide)
+                yield containers
+
+    def _index_shapes(self, containers, level, shape_list_parent):
+        for shape_idx, shape in enumerate(shape_list_parent.shapes):
+            containers.append(('shape', level, shape_idx, shape))
             if shape.has_text_frame:
                 if self._textframes:
-                    self._process_text_frame(level+1, shape, shape.text_frame)
-                elif self._verbose:
-                    print("%s... skipped" % ("  "*(level+1)))
+                    containers.append(('text frame', level+1, shape, shape.text_frame))
+                else:
+                    containers.append(('skipped', level+1))
             if shape.has_table:
                 table = shape.table
                 row_cnt = len(table.rows)
                 col_cnt = len(table.columns)
-                if self._verbose:
-                    print("%sTable[%s,%s]" % ( "  "*(level+1), row_cnt, col_cnt ) )
+                containers.append(('table', level+1, row_cnt, col_cnt))
                 if self._tables:
-                    for row in range(0, row_cnt):
-                        for col in range(0, col_cnt):
-                            cell = table.cell(row,col)
-                            if self._verbose:
-                                print("%sCell[%s,%s]: '%s'" % ( "  "*(level+2), row, col, cell.text ))
-                            self._process_text_frame(level+3, shape, cell.text_frame)
-                elif self._verbose:
-                    print("%s... skipped" % ( "  "*(level+2)))
+                    # Walk the <a:tc> elements directly instead of going through
+                    # table.cell(row,col) for every row/column pair. Cells spanned by
+                    # a merge (hMerge/vMerge) hold no text of their own and empty cells
+                    # can't match anything, so both are left out of the index.
+                    for row, tr in enumerate(table._tbl.tr_lst):
+                        for col, tc in enumerate(tr.tc_lst):
+                            if tc.hMerge or tc.vMerge or not self._has_text(tc):
+                                continue
+                            containers.append(('cell', level+2, shape, row, col, _Cell(tc, table)))
+                else:
+                    containers.append(('skipped', level+2))
             if shape.shape_type==MSO_SHAPE_TYPE.GROUP:
-                self._process_shapes(level+1, shape)
+                self._index_shapes(containers, level+1, shape)
             if shape.has_chart:
-                chart = shape.chart
+                containers.append(('chart', level+1, shape))
+                if not self._charts:
+                    containers.append(('skipped', level+2))
+
+    def _process_slide_masters_with_cache(self, master_cache):
+        # there are only a few slide masters, so they are indexed at once even in low memory mode
+        containers = list(self._get_text_containers("slide master"))
+        replacement_key = repr(( self._replacements, self._use_regex, self._textframes, self._tables ))
+        starts = [ i for i, container in enumerate(containers) if container[0] == 'slide' ] + [ len(containers) ]
+        for start, end in zip(starts[:-1], starts[1:]):
+            master_containers = containers[start:end]
+            master = master_containers[0][2]
+            part = master.part
+            if any(rel.reltype == RT.CHART for rel in part.rels.values()):
+                # rebuilding a chart changes other parts than the master itself,
+                # so this master can't be taken from the cache
+                self._process_text_containers(master_containers)
+                continue
+            key = (hashlib.sha256(part.blob).hexdigest(), replacement_key)
+            cached = master_cache.get(key)
+            if cached is None:
+                matches = self._run_stats['matches']
+                self._master_changes = []
+                try:
+                    self._process_text_containers(master_containers)
+                    master_cache.put(key, ( part.blob, self._run_stats['matches'] - matches, self._master_changes ))
+                finally:
+                    self._master_changes = None
+            else:
+                (xml, match_cnt, changes) = cached
+                self._current_slide_idx = master_containers[0][1]
+                self._run_stats['matches'] += match_cnt
+                if self._verbose:
+                    print("  Slide master[%s] ... edited XML taken from cache (%s matches)" % ( master_containers[0][1]+1, match_cnt ))
+                else:
+                    for change in changes:
+                        self._print_run_change(*change)
+                # All edits happen inside the shape tree. Its content is replaced in place,
+                # so all proxies holding on to it (like the slide master's shapes) stay valid.
+                element = part._element.cSld.spTree
+                edited = parse_xml(xml).cSld.spTree
+                element.attrib.clear()
+                element.attrib.update(edited.attrib)
+                element[:] = edited[:]
+                self._changed_parts.add(part)
+                # but the shapes of the slide masters have been replaced
+                self._text_containers.pop("slide master", None)
+                self._slide_done()
+
+    def _has_text(self, element):
+        for t in element.iter(qn('a:t')):
+            if t.text:
+                return True
+        return False
+
+    def _check_cancelled(self):
+        if self._cancellation_token is not None and self._cancellation_token.cancelled:
+            raise ReplacementCancelled("Text replacement in presentation %s has been cancelled." % ( self._presentation_file_name ))
+
+    def _slide_done(self):
+        if self._memory is not None:
+            if not self._low_memory and self._memory.is_pressing():
+                # Switch to the lower-memory strategy: don't keep the index of text
+                # containers (and all the proxies in it) anymore, but index one slide
+                # after the other while processing them.
+                self._low_memory = True
+                self._text_containers = {}
+                self._edit_plans.clear()
+                self._write_warning("Processing presentation %s is close to the memory budget, "
+                                    "switching to low memory mode." % ( self._presentation_file_name ))
+            self._memory.check("Processing presentation %s" % ( self._presentation_file_name ))
+        self._run_stats['slides'] += 1
+        self._run_stats['elapsed'] = time.time() - self._start_time
+        if self._progress is not None:
+            self._progress(self._run_stats['slides'], self._run_stats['slide_count'],
+                           self._run_stats['matches'], self._run_stats['elapsed'])
+
+    def _process_text_containers(self, containers):
+        in_slide = False
+        for container in containers:
+            kind = container[0]
+            if kind in ('slide', 'unloaded slide', 'shape'):
+                self._check_cancelled()
+            if kind in ('slide', 'unloaded slide'):
+                if in_slide:
+                    self._slide_done()
+                in_slide = True
+            if kind == 'slide':
+                (_, idx, slide, slide_type) = container
+                self._current_slide_idx = idx
+                if self._verbose:
+                    title = slide.shapes.title.text if slide.shapes.title else "<no title>"
+                    print(f"  {slide_type.capitalize()}[{idx + 1}, id={slide.slide_id}] with title '{title}'")
+            elif kind == 'unloaded slide':
+                (_, idx, slide_id, slide_type) = container
+                self._current_slide_idx = idx
+                if self._verbose:
+                    print(f"  {slide_type.capitalize()}[{idx + 1}, id={slide_id}] not loaded")
+            elif kind == 'skipped':
                 if self._verbose:
-                    print("%sChart of type %s" % ( "  "*(level+1), chart.chart_type ) )
+                    print("%s... skipped" % ("  "*container[1]))
+            elif kind == 'shape':
+                (_, level, shape_idx, shape) = container
+                if self._verbose:
+                    print("%sShape[%s, id=%s, type=%s]" % ( "  "*level, shape_idx, shape.shape_id, shape.shape_type ))
+            elif kind == 'text frame':
+                (_, level, shape, text_frame) = container
+                self._process_text_frame(level, shape, text_frame)
+            elif kind == 'table':
+                (_, level, row_cnt, col_cnt) = container
+                if self._verbose:
+                    print("%sTable[%s,%s]" % ( "  "*level, row_cnt, col_cnt ) )
+            elif kind == 'cell':
+                (_, level, shape, row, col, cell) = container
+                if self._verbose:
+                    print("%sCell[%s,%s]: '%s'" % ( "  "*level, row, col, cell.text ))
+                self._process_text_frame(level+1, shape, cell.text_frame)
+            elif kind == 'chart':
+                (_, level, shape) = container
+                if self._verbose:
+                    print("%sChart of type %s" % ( "  "*level, shape.chart.chart_type ) )
                 if self._charts:
-                    categories_changed = False
-                    new_categories = []
-                    category_idx = 0
-                    for category in chart.plots[0].categories:
-                        if self._verbose:
-                            print("%sCategory[%s] '%s'" % ( "  "*(level+2), category_idx, category ))
-                        for (srch,replace) in self._replacements:
-                            if self._use_regex:
-                                changed_category = re.sub(srch,replace,category,flags=re.MULTILINE)
-                            else:
-                                changed_category = category.replace(srch,replace)
-                            if changed_category == category:
-                                if self._verbose:
-                                    print("%sReplacing '%s' -> no match" % ( "  "*(level+3), srch ))
-                            else:
-                                if self._verbose:
-                                    print("%sReplacing '%s' -> changed to '%s'" % ( "  "*(level+3), srch, changed_category ))
-                                elif not self._quiet:
-                                    print("Slide[%s].%s[id=%s].Category[%s]: replacing '%s' -> '%s' changed to '%s'"
-                                            % (self._current_slide_idx+1, str(shape.shape_type)[0:str(shape.shape_type).find(' ')], shape.shape_id, category_idx, srch, category, changed_category))
-                                category = changed_category
-                                categories_changed = True
-                        new_categories.append(category)
-                        category_idx += 1
-
-                    if categories_changed:
-                        new_chart_data = CategoryChartData()
-                        new_chart_data.categories = new_categories
-                        for series in chart.series:
-                            new_chart_data.add_series(series.name,series.values)
-                        try:
-                            chart.replace_data(new_chart_data)
-                        except ValueError as err:
-                            self._write_error("Replacing chart data of chart with id %s on slide %s failed with error: %s"
-                                              % (shape.shape_id, self._current_slide_idx,str(err.args[0])))
-                elif self._verbose:
-                    print("%s... skipped" % ( "  "*(level+2)))
+                    self._replace_text_in_chart(level+1, shape)
+        if in_slide:
+            self._slide_done()
 
-def main():
-    copyleft = "python-pptx-text-replacer %s (c) Frank Schäckermann 2022" % __version__
-    p = argparse.ArgumentParser(description=__doc__,
-                                formatter_class=argparse.RawDescriptionHelpFormatter,
-                                epilog="""
-The parameters --match and --replace can be specified multiple times.
-They are paired up in the order of their appearance.
+    def _replace_text_in_chart(self, level, shape):
+        chart = shape.chart
+        categories_changed = False
+        new_categories = []
+        category_idx = 0
+        for category in chart.plots[0].categories:
+            if self._verbose:
+                print("%sCategory[%s] '%s'" % ( "  "*level, category_idx, category ))
+            for (srch,replace) in self._replacements:
+                if self._use_regex:
+                    changed_category = re.sub(srch,replace,category,flags=re.MULTILINE)
+                else:
+                    changed_category = category.replace(srch,replace)
+                if changed_category == category:
+                    if self._verbose:
+                        print("%sReplacing '%s' -> no match" % ( "  "*(level+1), srch ))
+                else:
+                    if self._verbose:
+                        print("%sReplacing '%s' -> changed to '%s'" % ( "  "*(level+1), srch, changed_category ))
+                    elif not self._quiet:
+                        print("Slide[%s].%s[id=%s].Category[%s]: replacing '%s' -> '%s' changed to '%s'"
+                                % (self._current_slide_idx+1, str(shape.shape_type)[0:str(shape.shape_type).find(' ')], shape.shape_id, category_idx, srch, category, changed_category))
+                    category = changed_category
+                    categories_changed = True
+                    self._run_stats['matches'] += 1
+            new_categories.append(category)
+            category_idx += 1
 
-The slide list given with --slides must be a comma-separated list of
-slide numbers from 1 to the number of slides contained in the presentation
-or slide number ranges of the kind '4-16'. If the second number is omitted,
-like in '4-' the range includes everything from the slide identified by the
-first number up to the last slide in the file.
+        if categories_changed:
+            new_chart_data = CategoryChartData()
+            new_chart_data.categories = new_categories
+            for series in chart.series:
+                new_chart_data.add_series(series.name,series.values)
+            try:
+                with MemoryPhase(self._memory, 'chart rebuild'):
+                    chart.replace_data(new_chart_data)
+                # replacing the data updates the chart's embedded workbook as well
+                self._changed_parts.add(chart.part)
+                workbook_part = chart.part.chart_workbook.xlsx_part
+                if workbook_part is not None:
+                    self._changed_parts.add(workbook_part)
+            except ValueError as err:
+                self._write_error("Replacing chart data of chart with id %s on slide %s failed with error: %s"
+                                  % (shape.shape_id, self._current_slide_idx,str(err.args[0])))
+            # rebuilding the chart is a structural change, so the index
+            # of text containers has to be built anew on next use
+            self._text_containers = {}
+            if self._memory is not None:
+                self._memory.check("Rebuilding chart with id %s on slide %s" % ( shape.shape_id, self._current_slide_idx+1 ))
 
-%s
-%s
-""" % ( "="*len(copyleft), copyleft ) )
+def _add_replacement_arguments(p):
     p.add_argument('--match',   '-m',
                    action='append',
                    required=True,
@@ -500,37 +946,9 @@ first number up to the last slide in the file.
                    dest='replacements',
                    metavar='<replacement>',
                    help="the replacement for all the matches' occurrences")
-    p.add_argument('--verbose','-v',
-                   action='store_const',
-                   dest='verbose',
-                   const=True,
-                   required=False,
-                   default=False,
-                   help="print detailed structure of and changes made in presentation file")
-    p.add_argument('--quiet','-q',
-                   action='store_const',
-                   dest='quiet',
-                   const=True,
-                   required=False,
-                   default=False,
-                   help="don't even print the changes that are done")
-    p.add_argument('--regex','-x',
-                   action='store_const',
-                   dest='use_regex',
-                   const=True,
-                   required=False,
-                   default=False,
-                   help="use match strings as regular expressions")
-    p.add_argument('--input',   '-i',
-                   action='store',
-                   required=True,
-                   metavar='<input file>',
-                   help="the file to replace the text in")
-    p.add_argument('--output',  '-o',
-                   action='store',
-                   required=True,
-                   metavar='<output file>',
-                   help="the file to write the changed presentation to")
+
+
+def _add_selection_arguments(p):
     p.add_argument('--slides', '-s',
                    metavar='<list of slide numbers to process>',
                    action='store',
@@ -580,12 +998,123 @@ first number up to the last slide in the file.
                    default=True,
                    help="do not process charts and their categories")
 
+
+def _print_progress(slides_done, slide_count, matches, elapsed):
+    width = 30
+    filled = width*slides_done//slide_count if slide_count > 0 else width
+    rate = slides_done/elapsed if elapsed > 0 else 0.0
+    print("\r[%s%s] %s/%s slides, %s matches, %.1fs (%.1f slides/s)"
+          % ( "#"*filled, "-"*(width-filled), slides_done, slide_count, matches, elapsed, rate ),
+          end='' if slides_done < slide_count else '\n', file=sys.stderr)
+    sys.stderr.flush()
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'watch':
+        from .HotFolder import main as watch_main
+        return watch_main(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == 'queue':
+        from .JobQueue import main as queue_main
+        return queue_main(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == 'apply-patch':
+        from .PresentationPatch import main as apply_patch_main
+        return apply_patch_main(sys.argv[2:])
+
+    copyleft = "python-pptx-text-replacer %s (c) Frank Schäckermann 2022" % __version__
+    p = argparse.ArgumentParser(description=__doc__,
+                                formatter_class=argparse.RawDescriptionHelpFormatter,
+                                epilog="""
+The parameters --match and --replace can be specified multiple times.
+They are paired up in the order of their appearance.
+
+The slide list given with --slides must be a comma-separated list of
+slide numbers from 1 to the number of slides contained in the presentation
+or slide number ranges of the kind '4-16'. If the second number is omitted,
+like in '4-' the range includes everything from the slide identified by the
+first number up to the last slide in the file.
+
+To watch a directory for presentations to process, call it with 'watch'
+as first parameter. Use 'watch --help' to get its parameters.
+
+A patch written with --patch is turned into the changed presentation
+by calling it with 'apply-patch' as first parameter. Use
+'apply-patch --help' to get its parameters.
+
+To enqueue jobs into or work on the jobs of a queue shared by several
+machines, call it with 'queue' as first parameter. Use 'queue --help'
+to get its parameters.
+
+%s
+%s
+""" % ( "="*len(copyleft), copyleft ) )
+    _add_replacement_arguments(p)
+    p.add_argument('--verbose','-v',
+                   action='store_const',
+                   dest='verbose',
+                   const=True,
+                   required=False,
+                   default=False,
+                   help="print detailed structure of and changes made in presentation file")
+    p.add_argument('--quiet','-q',
+                   action='store_const',
+                   dest='quiet',
+                   const=True,
+                   required=False,
+                   default=False,
+                   help="don't even print the changes that are done")
+    p.add_argument('--regex','-x',
+                   action='store_const',
+                   dest='use_regex',
+                   const=True,
+                   required=False,
+                   default=False,
+                   help="use match strings as regular expressions")
+    p.add_argument('--input',   '-i',
+                   action='store',
+                   required=True,
+                   metavar='<input file>',
+                   help="the file to replace the text in")
+    p.add_argument('--output',  '-o',
+                   action='store',
+                   required=True,
+                   metavar='<output file>',
+                   help="the file to write the changed presentation to")
+    _add_selection_arguments(p)
+
+    p.add_argument('--progress', '-p',
+                   action='store_const',
+                   dest='progress',
+                   const=True,
+                   required=False,
+                   default=False,
+                   help="print a progress bar to stderr while processing the slides")
+    p.add_argument('--memory-budget',
+                   action='store',
+                   type=int,
+                   required=False,
+                   default=None,
+                   metavar='<MB>',
+                   help="stop with an error instead of using more than this many megabytes of memory")
+    p.add_argument('--patch',
+                   action='store_const',
+                   dest='patch',
+                   const=True,
+                   required=False,
+                   default=False,
+                   help="write only the changed parts as patch to the output file")
+
     ns = p.parse_args(sys.argv[1:])
 
     if len(ns.matches) != len(ns.replacements):
         print("There must be as many match-strings (-m) as there are replacement-strings (-r)", file=sys.stderr)
         return 1
 
+    # SIGTERM cancels the replacement between two shapes and no output file is written
+    cancellation_token = CancellationToken()
+    try:
+        previous_handler = signal.signal(signal.SIGTERM, lambda signum, frame: cancellation_token.cancel())
+    except ValueError: # signal handlers can only be installed in the main thread
+        previous_handler = None
+
     try:
         replacer = TextReplacer(ns.input,
                                 tables=ns.tables,
@@ -593,18 +1122,35 @@ first number up to the last slide in the file.
                                 textframes=ns.textframes,
                                 slides=ns.slides,
                                 verbose=ns.verbose,
-                                quiet=ns.quiet)
+                                quiet=ns.quiet,
+                                memory_budget=None if ns.memory_budget is None else ns.memory_budget * 2**20)
         replacements = []
         for m in range(0,len(ns.matches)):
             replacements.append( ( ns.matches[m], ns.replacements[m] ) )
         
-        replacer.replace_text(replacements, use_regex=ns.use_regex)
-        replacer.write_presentation_to_file(ns.output)
+        replacer.replace_text(replacements, use_regex=ns.use_regex,
+                              progress=_print_progress if ns.progress else None,
+                              cancellation_token=cancellation_token)
+        if cancellation_token.cancelled:
+            raise ReplacementCancelled("Text replacement in presentation %s has been cancelled." % ( ns.input ))
+        if ns.patch:
+            replacer.write_presentation_patch(ns.output)
+        else:
+            replacer.write_presentation_to_file(ns.output)
 
         return 0
     except ValueError as err:
         print(str(err.args[0]), file=sys.stderr)
         return 1
+    except ReplacementCancelled as err:
+        print(str(err.args[0]), file=sys.stderr)
+        return 1
+    except MemoryBudgetExceeded as err:
+        print(str(err.args[0]), file=sys.stderr)
+        return 1
+    finally:
+        if previous_handler is not None:
+            signal.signal(signal.SIGTERM, previous_handler)
 
 if __name__ == '__main__':
     sys.exit(main())
@@ -1 +1,3 @@
-from .TextReplacer import TextReplacer
+from .TextReplacer import TextReplacer, SlideMasterCache, CancellationToken, ReplacementCancelled
+from .MemoryTracker import MemoryBudgetExceeded
+from .AsyncTextReplacer import AsyncTextReplacer, replace_async
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import io
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from pptx import Presentation
+from python_pptx_text_replacer import AsyncTextReplacer, CancellationToken, ReplacementCancelled, SlideMasterCache, \
+                                      replace_async
+
+
+class BlockingExecutor(ThreadPoolExecutor):
+    """A thread pool whose jobs wait for an event before they start."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.go = threading.Event()
+        self.started = 0
+        self.futures = []
+        self.max_running = 0
+        self._running = 0
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        def job():
+            with self._lock:
+                self.started += 1
+                self._running += 1
+                self.max_running = max(self.max_running, self._running)
+            try:
+                self.go.wait()
+                return fn(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self._running -= 1
+        future = super().submit(job)
+        self.futures.append(future)
+        return future
+
+
+class test_async_text_replacer(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def text_of(self, data):
+        prs = Presentation(io.BytesIO(data) if isinstance(data, bytes) else data)
+        return prs.slides[0].shapes[1].text_frame.text
+
+    def test_01_replace_returns_bytes(self):
+        data = asyncio.run(replace_async('tests/data/test-03.pptx', [('How are you?', "I'm fine!")], quiet=True))
+        self.assertEqual(self.text_of(data), "Hello there! I'm fine! What is your name?")
+
+    def test_02_replace_writes_output_file(self):
+        output = os.path.join(self._tmp_dir, 'out.pptx')
+
+        async def run():
+            async with AsyncTextReplacer(max_concurrency=2) as replacer:
+                return await replacer.replace('tests/data/test-04.pptx', [(r'How ..(.) you\?', r"I'm fin\1!")],
+                                              output=output, use_regex=True, quiet=True)
+
+        self.assertEqual(asyncio.run(run()), output)
+        self.assertEqual(self.text_of(output), "Hello there! I'm fine! What\tis your name?")
+        self.assertEqual(os.listdir(self._tmp_dir), ['out.pptx'])
+
+    def test_03_concurrency_is_bounded(self):
+        executor = BlockingExecutor(max_workers=4)
+
+        async def run():
+            replacer = AsyncTextReplacer(executor=executor, max_concurrency=2)
+            tasks = [asyncio.ensure_future(replacer.replace('tests/data/test-03.pptx', [('are', 'ARE')], quiet=True))
+                     for _ in range(5)]
+            await asyncio.sleep(0.2)
+            started = executor.started
+            executor.go.set()
+            results = await asyncio.gather(*tasks)
+            return started, results
+
+        started, results = asyncio.run(run())
+        executor.shutdown()
+        self.assertEqual(started, 2)
+        self.assertEqual(executor.max_running, 2)
+        self.assertEqual(len(results), 5)
+
+    def test_04_cancellation_writes_no_output(self):
+        executor = BlockingExecutor(max_workers=1)
+        output = os.path.join(self._tmp_dir, 'out.pptx')
+
+        async def run():
+            replacer = AsyncTextReplacer(executor=executor, max_concurrency=1)
+            first = asyncio.ensure_future(replacer.replace('tests/data/test-03.pptx', [('are', 'ARE')],
+                                                           output=output, quiet=True))
+            second = asyncio.ensure_future(replacer.replace('tests/data/test-03.pptx', [('are', 'ARE')], quiet=True))
+            await asyncio.sleep(0.1)
+            first.cancel()
+            second.cancel()
+            executor.go.set()
+            for task in (first, second):
+                with self.assertRaises(asyncio.CancelledError):
+                    await task
+            # the slot of the cancelled, but running job is given free again
+            return await replacer.replace('tests/data/test-03.pptx', [('are', 'ARE')], quiet=True)
+
+        data = asyncio.run(run())
+        executor.shutdown()
+        self.assertIn('ARE', self.text_of(data))
+        self.assertFalse(os.path.exists(output))
+
+    def test_05_replacer_is_used_in_several_event_loops(self):
+        async def run():
+            return await asyncio.gather(*[ replace_async('tests/data/test-03.pptx', [('are', 'ARE')], quiet=True)
+                                           for _ in range(8) ])
+
+        for _ in range(2):
+            self.assertEqual(len(asyncio.run(run())), 8)
+
+    def test_06_cancellation_stops_running_job(self):
+        executor = BlockingExecutor(max_workers=1)
+
+        async def run():
+            replacer = AsyncTextReplacer(executor=executor, max_concurrency=1)
+            task = asyncio.ensure_future(replacer.replace('tests/data/test-03.pptx', [('are', 'ARE')], quiet=True))
+            await asyncio.sleep(0.1)
+            # the job is running already (waiting for go), so only the token can stop it
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            executor.go.set()
+
+        asyncio.run(run())
+        executor.shutdown()
+        self.assertIsInstance(executor.futures[0].exception(), ReplacementCancelled)
+
+    def test_07_master_cache_is_shared_by_jobs(self):
+        cache = SlideMasterCache()
+
+        async def run():
+            for _ in range(2):
+                await replace_async('tests/data/test-03.pptx', [('are', 'ARE')], quiet=True, master_cache=cache)
+
+        asyncio.run(run())
+        self.assertGreater(cache.hits, 0)
+
+    def test_08_progress_and_cancellation_token(self):
+        token = CancellationToken()
+        calls = []
+
+        def progress(slides_done, slide_count, matches, elapsed):
+            calls.append(slides_done)
+            token.cancel()
+
+        async def run():
+            await replace_async('tests/data/Test-Presentation.pptx', [('Text', 'Txt')], quiet=True,
+                                progress=progress, cancellation_token=token)
+
+        with self.assertRaises(ReplacementCancelled):
+            asyncio.run(run())
+        self.assertEqual(calls, [ 1 ])
+
+    def test_09_closing_does_not_block_the_event_loop(self):
+        executor = BlockingExecutor(max_workers=1)
+        ticks = []
+
+        async def tick():
+            while True:
+                ticks.append(time.time())
+                await asyncio.sleep(0.01)
+
+        async def run():
+            async with AsyncTextReplacer(max_concurrency=1) as replacer:
+                replacer._executor.shutdown()
+                replacer._executor = executor
+                task = asyncio.ensure_future(replacer.replace('tests/data/test-03.pptx', [('are', 'ARE')], quiet=True))
+                await asyncio.sleep(0.05)
+                task.cancel()
+                ticker = asyncio.ensure_future(tick())
+                # the job still runs while the replacer is closed
+                threading.Timer(0.3, executor.go.set).start()
+            ticker.cancel()
+
+        asyncio.run(run())
+        self.assertGreater(len(ticks), 10)
@@ -0,0 +1,468 @@
+# -*- coding: utf-8 -*-
+"""
+Differential tests comparing TextReplacer with a reference implementation, a frozen
+copy of the original TextReplacer, that walks the full shape tree on every call and
+visits every table cell via table.cell(row,col).
+
+Randomized decks (fragmented runs with differing formatting, multi-paragraph
+text frames repeated across shapes and slides, tables with merged cells, groups
+and charts) and randomized replacements are run through the reference and through
+every engine in ENGINES.
+The resulting XML parts must be identical. A failing case is shrunk to a minimal
+reproducer before it is reported.
+
+The number of cases can be raised with the environment variable
+PPTX_EQUIVALENCE_CASES.
+"""
+from __future__ import print_function, unicode_literals
+
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import unittest
+
+from lxml import etree
+from pptx import Presentation
+from pptx.chart.data import CategoryChartData
+from pptx.dml.color import RGBColor
+from pptx.enum.chart import XL_CHART_TYPE
+from pptx.enum.dml import MSO_COLOR_TYPE
+from pptx.enum.shapes import MSO_SHAPE_TYPE
+from pptx.util import Inches, Pt
+
+from python_pptx_text_replacer import TextReplacer, SlideMasterCache
+
+ALPHABET = 'abc '
+PATTERNS = [ 'a.', 'b+', 'c a', '[ab]c', 'a\\s', 'b.c' ]
+CASES = int(os.environ.get('PPTX_EQUIVALENCE_CASES', '25'))
+
+
+class ReferenceTextReplacer:
+    """
+    A frozen copy of the original implementation: it walks the whole shape tree on
+    every call to replace_text, visits every cell of a table by table.cell(row,col)
+    and does the replacements in every text frame from scratch. The matching, run
+    splitting and chart logic below is the one of the original TextReplacer, with its
+    output (the reference always runs quietly) and Python 2 support left out, so that
+    a regression in that logic of TextReplacer shows up as a difference.
+    """
+
+    def __init__(self, presentation_file_name, selection=()):
+        self._presentation = Presentation(presentation_file_name)
+        self._selection = selection
+        self._messages = []
+
+    def replace_text(self, replacements, use_regex=False):
+        self._replacements = list(replacements)
+        self._use_regex = use_regex
+        for idx, slide in enumerate(self._presentation.slides):
+            if not self._selection or idx+1 in self._selection:
+                self._process_shapes(slide)
+        for slide in self._presentation.slide_masters:
+            self._process_shapes(slide)
+
+    def _replace_text_in_text_frame(self, text_frame):
+        for (srch, replacement) in self._replacements:
+            text = "\n".join("".join(run.text for run in par.runs) for par in text_frame.paragraphs)
+            if self._use_regex:
+                matches = list(m for m in re.finditer(srch, text, flags=re.MULTILINE))
+                if len(matches)>0:
+                    matcher = matches.pop()
+                    pos_in_text_frame = matcher.start(0)
+                    to_match = matcher.group(0)
+                    to_replace = matcher.expand(replacement)
+                else:
+                    pos_in_text_frame = -1
+            else:
+                to_match = srch
+                to_replace = replacement
+                pos_in_text_frame = text.find(srch)
+            while pos_in_text_frame>=0:
+                to_replace_len = len(to_replace)
+                pos_in_paragraph = pos_in_text_frame
+                for paragraph in text_frame.paragraphs:
+                    para_text = "".join(run.text for run in paragraph.runs)
+                    paragraph_len = len(para_text)
+                    if pos_in_paragraph >= paragraph_len:
+                        pos_in_paragraph -= paragraph_len+1 # +1 for the new-line-character
+                    else:
+                        # this is the paragraph that contains the beginning of the match
+                        (to_match, to_replace) = self._replace_runs_text(paragraph.runs, pos_in_paragraph, to_match, to_replace)
+                        if len(to_match) == 0: # are we done with this match
+                            break
+                        pos_in_paragraph = 0
+                if self._use_regex:
+                    if len(matches)>0:
+                        matcher = matches.pop()
+                        pos_in_text_frame = matcher.start(0)
+                        to_match = matcher.group(0)
+                        to_replace = matcher.expand(replacement)
+                    else:
+                        pos_in_text_frame = -1
+                else:
+                    to_match = srch
+                    to_replace = replacement
+                    text = "\n".join("".join(run.text for run in par.runs) for par in text_frame.paragraphs)
+                    pos_in_text_frame = text.find(srch,pos_in_text_frame+to_replace_len)
+
+    def _save_font_configuration(self, font):
+        saved = {}
+        saved['name'] = font.name
+        saved['size'] = font.size
+        saved['bold'] = font.bold
+        saved['italic'] = font.italic
+        saved['underline'] = font.underline
+        saved['color.type'] = font.color.type
+        if font.color.type == MSO_COLOR_TYPE.SCHEME:
+            saved['color.brightness'] = font.color.brightness
+            saved['color.theme_color'] = font.color.theme_color
+        elif font.color.type == MSO_COLOR_TYPE.RGB:
+            saved['color.rgb'] = None if font.color.rgb is None else str(font.color.rgb)
+        return saved
+
+    def _restore_font_configuration(self, saved, font):
+        font.name = saved['name']
+        font.size = saved['size']
+        font.bold = saved['bold']
+        font.italic = saved['italic']
+        font.underline = saved['underline']
+        if saved['color.type'] == MSO_COLOR_TYPE.SCHEME:
+            font.color.brightness = saved['color.brightness']
+            font.color.theme_color = saved['color.theme_color']
+        elif saved['color.type'] == MSO_COLOR_TYPE.RGB:
+            if saved['color.rgb'] is not None:
+                font.color.rgb = RGBColor.from_string(saved['color.rgb'])
+            else:
+                font.color.rgb = None
+
+    def _set_text(self, run, text):
+        saved_font = self._save_font_configuration(run.font)
+        run.text = text
+        self._restore_font_configuration(saved_font, run.font)
+
+    def _replace_runs_text(self, runs, pos, srch, replacement):
+        cnt = len(runs)
+        i = 0
+        while i<cnt:
+            olen = len(runs[i].text)
+            if pos>=olen:
+                pos -= olen # the relative position of our match in the next run's text
+                i += 1      # and off to the next run
+            else:
+                # we found the run, where the match starts!
+                to_match = srch
+                match_len = len(to_match)
+                to_replace = replacement
+                repl_len = len(to_replace)
+
+                while i<cnt:
+                    run = runs[i]
+                    otext = run.text
+                    olen = len(otext)
+                    if pos+match_len < olen:
+                        # our match ends before the end of the text of this run
+                        self._set_text(run, otext[0:pos]+to_replace+otext[pos+match_len:])
+                        return ('','')
+                    if pos+match_len == olen:
+                        # our match ends together with the text of this run
+                        self._set_text(run, otext[0:pos]+to_replace)
+                        return ('','')
+                    # we still haven't found all of our original match string
+                    # so we process what we have here and go on to the next run
+                    part_match_len = olen-pos
+                    ntext = otext[0:pos]
+                    if repl_len <= part_match_len:
+                        # use up the rest of the replacement string here, the remainder
+                        # of the match is replaced with an empty string in the next runs
+                        ntext += to_replace
+                        repl_len = 0
+                        to_replace = ''
+                    else:
+                        ntext += to_replace[0:part_match_len]
+                        to_replace = to_replace[part_match_len:]
+                        repl_len -= part_match_len
+                    self._set_text(run, ntext)
+                    to_match = to_match[part_match_len:] # this is what is left to match
+                    match_len -= part_match_len # this is the length of the match that is left
+                    pos = 0                     # in the next run, we start at pos 0 with our match
+                    i += 1                      # and off to the next run
+                return (to_match, to_replace)
+
+    def _process_shapes(self, shape_list_parent):
+        for shape in shape_list_parent.shapes:
+            if shape.has_text_frame:
+                self._replace_text_in_text_frame(shape.text_frame)
+            if shape.has_table:
+                table = shape.table
+                for row in range(0, len(table.rows)):
+                    for col in range(0, len(table.columns)):
+                        self._replace_text_in_text_frame(table.cell(row,col).text_frame)
+            if shape.shape_type==MSO_SHAPE_TYPE.GROUP:
+                self._process_shapes(shape)
+            if shape.has_chart:
+                chart = shape.chart
+                categories_changed = False
+                new_categories = []
+                for category in chart.plots[0].categories:
+                    for (srch,replace) in self._replacements:
+                        if self._use_regex:
+                            changed_category = re.sub(srch,replace,category,flags=re.MULTILINE)
+                        else:
+                            changed_category = category.replace(srch,replace)
+                        if changed_category != category:
+                            category = changed_category
+                            categories_changed = True
+                    new_categories.append(category)
+
+                if categories_changed:
+                    new_chart_data = CategoryChartData()
+                    new_chart_data.categories = new_categories
+                    for series in chart.series:
+                        new_chart_data.add_series(series.name,series.values)
+                    try:
+                        chart.replace_data(new_chart_data)
+                    except ValueError as err:
+                        self._messages.append("ERROR: Replacing chart data of chart with id %s failed with error: %s"
+                                              % (shape.shape_id, str(err.args[0])))
+
+
+def run_reference(file_name, stages, use_regex, selection=()):
+    replacer = ReferenceTextReplacer(file_name, selection)
+    for replacements in stages:
+        replacer.replace_text(replacements, use_regex=use_regex)
+    return replacer
+
+
+def run_indexed(file_name, stages, use_regex, selection=()):
+    replacer = TextReplacer(file_name, quiet=True)
+    for replacements in stages:
+        replacer.replace_text(replacements, use_regex=use_regex)
+    return replacer
+
+
+def run_master_cache(file_name, stages, use_regex, selection=()):
+    # the first deck fills the cache, the second one is served from it
+    cache = SlideMasterCache()
+    for _ in range(2):
+        replacer = TextReplacer(file_name, quiet=True)
+        for replacements in stages:
+            replacer.replace_text(replacements, use_regex=use_regex, master_cache=cache)
+    return replacer
+
+
+def run_small_edit_plan_cache(file_name, stages, use_regex, selection=()):
+    # a tiny cache, so that edit plans get evicted and computed again
+    replacer = TextReplacer(file_name, quiet=True, edit_plan_cache_size=2)
+    for replacements in stages:
+        replacer.replace_text(replacements, use_regex=use_regex)
+    return replacer
+
+
+def run_low_memory(file_name, stages, use_regex, selection=()):
+    # the text containers are produced slide by slide instead of kept in an index
+    replacer = TextReplacer(file_name, quiet=True)
+    replacer._low_memory = True
+    for replacements in stages:
+        replacer.replace_text(replacements, use_regex=use_regex)
+    return replacer
+
+
+def run_selected_slides(file_name, stages, use_regex, selection=()):
+    # the slides not selected are loaded as plain parts, that are never parsed
+    replacer = TextReplacer(file_name, quiet=True, slides=",".join(str(number) for number in selection))
+    for replacements in stages:
+        replacer.replace_text(replacements, use_regex=use_regex)
+    return replacer
+
+
+# name, engine and whether the engine processes only the selected slides of a case
+ENGINES = [
+    ('indexed', run_indexed, False),
+    ('master cache', run_master_cache, False),
+    ('small edit plan cache', run_small_edit_plan_cache, False),
+    ('low memory', run_low_memory, False),
+    ('selected slides', run_selected_slides, True),
+]
+
+
+def random_text(rnd, max_len=6):
+    return ''.join(rnd.choice(ALPHABET) for _ in range(rnd.randint(0, max_len)))
+
+
+def random_paragraphs(rnd):
+    return [ [ random_text(rnd) for _ in range(rnd.randint(0, 4)) ] for _ in range(rnd.randint(1, 3)) ]
+
+
+def random_shape(rnd, in_group=False):
+    # python-pptx can't add tables or nested groups to a group
+    kind = rnd.choice([ 'textbox', 'textbox', 'chart' ] + ([] if in_group else [ 'table', 'group' ]))
+    if kind == 'textbox':
+        return ('textbox', random_paragraphs(rnd))
+    if kind == 'table':
+        rows = rnd.randint(1, 4)
+        cols = rnd.randint(1, 4)
+        cells = [ [ random_paragraphs(rnd) for _ in range(cols) ] for _ in range(rows) ]
+        merges = []
+        if rows > 1 and cols > 1 and rnd.random() < 0.5:
+            merges.append((0, 0, rnd.randint(0, 1), 1))
+        return ('table', cells, merges)
+    if kind == 'chart':
+        return ('chart', [ random_text(rnd, 4) or 'x' for _ in range(rnd.randint(1, 4)) ])
+    return ('group', [ random_shape(rnd, in_group=True) for _ in range(rnd.randint(1, 3)) ])
+
+
+def random_case(seed):
+    rnd = random.Random(seed)
+    use_regex = rnd.random() < 0.3
+    slides = [ [ random_shape(rnd) for _ in range(rnd.randint(0, 3)) ] for _ in range(rnd.randint(1, 3)) ]
+    # repeat some of the text boxes, like footers repeated on every slide
+    textboxes = [ shape for slide in slides for shape in slide if shape[0] == 'textbox' ]
+    if textboxes:
+        for slide in slides:
+            for _ in range(rnd.randint(0, 2)):
+                slide.insert(rnd.randint(0, len(slide)), rnd.choice(textboxes))
+    stages = []
+    for _ in range(rnd.randint(1, 2)):
+        replacements = []
+        for _ in range(rnd.randint(1, 3)):
+            srch = rnd.choice(PATTERNS) if use_regex else random_text(rnd, 3).strip(' ') or 'a'
+            replacements.append((srch, random_text(rnd, 4)))
+        stages.append(replacements)
+    selection = sorted(rnd.sample(range(1, len(slides)+1), rnd.randint(1, len(slides))))
+    return { 'slides': slides, 'stages': stages, 'use_regex': use_regex, 'selection': selection }
+
+
+def fill_text_frame(text_frame, paragraphs):
+    for paragraph_idx, runs in enumerate(paragraphs):
+        paragraph = text_frame.paragraphs[0] if paragraph_idx == 0 else text_frame.add_paragraph()
+        for run_idx, text in enumerate(runs):
+            run = paragraph.add_run()
+            run.text = text
+            run.font.bold = run_idx % 2 == 1
+            run.font.size = Pt(10 + run_idx)
+
+
+def add_shape(shapes, shape_spec):
+    kind = shape_spec[0]
+    if kind == 'textbox':
+        fill_text_frame(shapes.add_textbox(Inches(1), Inches(1), Inches(3), Inches(1)).text_frame, shape_spec[1])
+    elif kind == 'table':
+        cells, merges = shape_spec[1], shape_spec[2]
+        table = shapes.add_table(len(cells), len(cells[0]), Inches(1), Inches(2), Inches(6), Inches(2)).table
+        for row, row_cells in enumerate(cells):
+            for col, paragraphs in enumerate(row_cells):
+                fill_text_frame(table.cell(row, col).text_frame, paragraphs)
+        for (row1, col1, row2, col2) in merges:
+            table.cell(row1, col1).merge(table.cell(row2, col2))
+    elif kind == 'chart':
+        chart_data = CategoryChartData()
+        chart_data.categories = shape_spec[1]
+        chart_data.add_series('Series 1', list(range(len(shape_spec[1]))))
+        shapes.add_chart(XL_CHART_TYPE.COLUMN_CLUSTERED, Inches(1), Inches(4), Inches(4), Inches(3), chart_data)
+    elif kind == 'group':
+        group = shapes.add_group_shape()
+        for member in shape_spec[1]:
+            add_shape(group.shapes, member)
+
+
+def build_deck(case, file_name):
+    prs = Presentation()
+    for slide_spec in case['slides']:
+        slide = prs.slides.add_slide(prs.slide_layouts[6])
+        for shape_spec in slide_spec:
+            add_shape(slide.shapes, shape_spec)
+    prs.save(file_name)
+
+
+def xml_parts(replacer):
+    # canonical XML, because the parts of slides that are not selected keep their original serialization
+    return dict((str(part.partname), etree.tostring(etree.fromstring(part.blob), method='c14n'))
+                for part in replacer._presentation.part.package.iter_parts()
+                if part.content_type.endswith('+xml'))
+
+
+def shrink_candidates(case):
+    # every candidate is the case with one element removed or simplified
+    slides, stages = case['slides'], case['stages']
+    for i in range(len(slides)):
+        yield dict(case, slides=slides[:i]+slides[i+1:])
+    for i, slide in enumerate(slides):
+        for j in range(len(slide)):
+            yield dict(case, slides=slides[:i]+[slide[:j]+slide[j+1:]]+slides[i+1:])
+        for j, shape in enumerate(slide):
+            if shape[0] == 'textbox':
+                paragraphs = shape[1]
+                for k in range(len(paragraphs)):
+                    if len(paragraphs) > 1:
+                        smaller = ('textbox', paragraphs[:k]+paragraphs[k+1:])
+                        yield dict(case, slides=slides[:i]+[slide[:j]+[smaller]+slide[j+1:]]+slides[i+1:])
+                    for m in range(len(paragraphs[k])):
+                        runs = paragraphs[k][:m]+paragraphs[k][m+1:]
+                        smaller = ('textbox', paragraphs[:k]+[runs]+paragraphs[k+1:])
+                        yield dict(case, slides=slides[:i]+[slide[:j]+[smaller]+slide[j+1:]]+slides[i+1:])
+            elif shape[0] == 'group':
+                for member in shape[1]:
+                    yield dict(case, slides=slides[:i]+[slide[:j]+[member]+slide[j+1:]]+slides[i+1:])
+            elif shape[0] == 'table':
+                if shape[2]:
+                    yield dict(case, slides=slides[:i]+[slide[:j]+[('table', shape[1], [])]+slide[j+1:]]+slides[i+1:])
+                for row, row_cells in enumerate(shape[1]):
+                    for col, paragraphs in enumerate(row_cells):
+                        if paragraphs != [[]]:
+                            cells = [ list(r) for r in shape[1] ]
+                            cells[row][col] = [[]]
+                            smaller = ('table', cells, shape[2])
+                            yield dict(case, slides=slides[:i]+[slide[:j]+[smaller]+slide[j+1:]]+slides[i+1:])
+    if len(stages) > 1:
+        for i in range(len(stages)):
+            yield dict(case, stages=stages[:i]+stages[i+1:])
+    for i, replacements in enumerate(stages):
+        if len(replacements) > 1:
+            for j in range(len(replacements)):
+                yield dict(case, stages=stages[:i]+[replacements[:j]+replacements[j+1:]]+stages[i+1:])
+
+
+class test_equivalence(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp()
+        self._stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def tearDown(self):
+        sys.stdout.close()
+        sys.stdout = self._stdout
+        shutil.rmtree(self._tmp_dir)
+
+    def differences(self, case, engine, uses_selection):
+        file_name = os.path.join(self._tmp_dir, 'case.pptx')
+        build_deck(case, file_name)
+        # shrinking may have removed selected slides
+        selection = [ number for number in case['selection'] if number <= len(case['slides']) ] if uses_selection else []
+        expected = xml_parts(run_reference(file_name, case['stages'], case['use_regex'], selection))
+        actual = xml_parts(engine(file_name, case['stages'], case['use_regex'], selection))
+        return sorted(partname for partname in set(expected) | set(actual)
+                      if expected.get(partname) != actual.get(partname))
+
+    def shrink(self, case, engine, uses_selection):
+        progress = True
+        while progress:
+            progress = False
+            for candidate in shrink_candidates(case):
+                if self.differences(candidate, engine, uses_selection):
+                    case = candidate
+                    progress = True
+                    break
+        return case
+
+    def test_01_engines_match_reference(self):
+        for seed in range(CASES):
+            case = random_case(seed)
+            for (engine_name, engine, uses_selection) in ENGINES:
+                if self.differences(case, engine, uses_selection):
+                    minimal = self.shrink(case, engine, uses_selection)
+                    self.fail("Engine '%s' differs from the reference for seed %s in parts %s. Minimal case: %r"
+                              % ( engine_name, seed, self.differences(minimal, engine, uses_selection), minimal ))
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from pptx import Presentation
+from python_pptx_text_replacer.HotFolder import HotFolder
+
+
+class test_hot_folder(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp()
+        self._input_dir = os.path.join(self._tmp_dir, 'in')
+        self._output_dir = os.path.join(self._tmp_dir, 'out')
+        self._status_file = os.path.join(self._tmp_dir, 'status.json')
+        os.mkdir(self._input_dir)
+        os.mkdir(self._output_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def hot_folder(self, debounce):
+        return HotFolder(self._input_dir, self._output_dir, [('How are you?', "I'm fine!")],
+                         workers=1, debounce=debounce, status_file=self._status_file)
+
+    def test_01_processes_ready_files(self):
+        shutil.copy('tests/data/test-03.pptx', os.path.join(self._input_dir, 'a.pptx'))
+        with open(os.path.join(self._input_dir, 'broken.pptx'), 'wb') as f:
+            f.write(b'no presentation')
+        with open(os.path.join(self._input_dir, '~$a.pptx'), 'wb') as f:
+            f.write(b'lock file')
+        hot_folder = self.hot_folder(0)
+        try:
+            wait(hot_folder.poll())
+            # nothing changed, so nothing is queued again
+            self.assertEqual(hot_folder.poll(), [])
+        finally:
+            hot_folder.close()
+        self.assertEqual(sorted(os.listdir(self._output_dir)), ['a.pptx'])
+        prs = Presentation(os.path.join(self._output_dir, 'a.pptx'))
+        self.assertEqual(prs.slides[0].shapes[1].text_frame.text, "Hello there! I'm fine! What is your name?")
+        with open(self._status_file) as f:
+            status = json.load(f)
+        self.assertEqual((status['processed'], status['failed'], status['matches']), (1, 1, 1))
+        self.assertEqual(status['failures'][0]['file'], 'broken.pptx')
+
+    def test_02_debounces_files_being_written(self):
+        file_name = os.path.join(self._input_dir, 'a.pptx')
+        shutil.copy('tests/data/test-03.pptx', file_name)
+        hot_folder = self.hot_folder(0.3)
+        try:
+            self.assertEqual(hot_folder.scan(), [])
+            time.sleep(0.2)
+            with open(file_name, 'ab') as f:
+                f.write(b'\0')
+            self.assertEqual(hot_folder.scan(), [])
+            time.sleep(0.2)
+            self.assertEqual(hot_folder.scan(), [])
+            time.sleep(0.2)
+            self.assertEqual(hot_folder.scan(), ['a.pptx'])
+        finally:
+            hot_folder.close()
+
+    def test_03_recovers_from_dead_worker_process(self):
+        hot_folder = self.hot_folder(0)
+        try:
+            # a worker process dying (like one killed by the OOM killer) breaks the pool
+            hot_folder._executor = ProcessPoolExecutor(max_workers=1)
+            with self.assertRaises(BrokenProcessPool):
+                hot_folder._executor.submit(os._exit, 1).result()
+            shutil.copy('tests/data/test-03.pptx', os.path.join(self._input_dir, 'a.pptx'))
+            wait(hot_folder.poll())
+        finally:
+            hot_folder.close()
+        self.assertEqual(os.listdir(self._output_dir), ['a.pptx'])
+        self.assertEqual(hot_folder.get_status()['processed'], 1)
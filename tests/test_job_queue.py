@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import sqlite3
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from pptx import Presentation
+from python_pptx_text_replacer.JobQueue import JobQueue
+
+
+class test_job_queue(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp()
+        self._database = os.path.join(self._tmp_dir, 'queue.db')
+        self._manifest = os.path.join(self._tmp_dir, 'manifest.jsonl')
+        with open(self._manifest, 'w') as f:
+            for i in range(4):
+                f.write(json.dumps({ 'input': 'tests/data/test-03.pptx',
+                                     'output': os.path.join(self._tmp_dir, 'out', '%s.pptx' % i),
+                                     'replacements': [ [ 'How are you?', "I'm fine!" ] ] }) + '\n')
+            f.write(json.dumps({ 'input': 'tests/data/missing.pptx',
+                                 'output': os.path.join(self._tmp_dir, 'out', 'missing.pptx'),
+                                 'replacements': [ [ 'a', 'b' ] ] }) + '\n')
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def test_01_workers_share_the_queue(self):
+        queue = JobQueue(self._database, max_attempts=2)
+        self.assertEqual(queue.enqueue_manifest(self._manifest), 5)
+        processed = []
+        workers = [ threading.Thread(target=lambda name=name: processed.append(JobQueue(self._database, max_attempts=2).work(worker_id=name)))
+                    for name in ('node-1', 'node-2') ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        # the failing job is tried twice
+        self.assertEqual(sum(processed), 6)
+        report = queue.report()
+        self.assertEqual((report['jobs'], report['done'], report['failed'], report['matches']), (5, 4, 1, 4))
+        self.assertEqual(report['failures'][0]['attempts'], 2)
+        self.assertIn('does not exist', report['failures'][0]['error'])
+        prs = Presentation(os.path.join(self._tmp_dir, 'out', '3.pptx'))
+        self.assertEqual(prs.slides[0].shapes[1].text_frame.text, "Hello there! I'm fine! What is your name?")
+
+    def test_02_jobs_of_dead_workers_are_retried(self):
+        queue = JobQueue(self._database, lease=0.2)
+        queue.enqueue_manifest(self._manifest)
+        job = queue.claim('dead-node')
+        self.assertEqual(job['attempts'], 1)
+        # the dead worker doesn't send heartbeats, so its lease expires
+        time.sleep(0.3)
+        self.assertEqual(queue.claim('live-node')['id'], job['id'])
+        self.assertFalse(queue.heartbeat(job['id'], 'dead-node'))
+        self.assertTrue(queue.heartbeat(job['id'], 'live-node'))
+
+    def test_03_worker_reuses_edited_slide_masters(self):
+        queue = JobQueue(self._database)
+        queue.enqueue_manifest(self._manifest)
+        queue.work(worker_id='node-1')
+        self.assertGreater(queue._master_cache.hits, 0)
+
+    def test_04_workers_wait_for_running_jobs(self):
+        queue = JobQueue(self._database, lease=0.3)
+        queue.enqueue_manifest(self._manifest)
+        # this worker dies before the others ran out of queued jobs
+        job = queue.claim('dead-node')
+        queue.work(worker_id='live-node')
+        report = queue.report()
+        self.assertEqual((report['queued'], report['running'], report['done']), (0, 0, 4))
+        self.assertEqual(report['workers'], { 'live-node': 4 })
+        self.assertTrue(os.path.exists(os.path.join(self._tmp_dir, 'out', '%s.pptx' % (job['id']-1))))
+
+    def test_05_job_is_given_up_when_lease_is_lost(self):
+        class LosingQueue(JobQueue):
+            def heartbeat(self, job_id, worker_id):
+                return False
+
+            def process(self, job, cancellation_token=None):
+                time.sleep(0.2)
+                return JobQueue.process(self, job, cancellation_token)
+
+        queue = LosingQueue(self._database, lease=0.3)
+        queue.enqueue([ { 'input': 'tests/data/test-03.pptx',
+                          'output': os.path.join(self._tmp_dir, 'out', 'lost.pptx'),
+                          'replacements': [ [ 'are', 'ARE' ] ] } ])
+        stop = threading.Event()
+        # the lease isn't really lost, so stop the worker instead of waiting for the job
+        threading.Timer(0.5, stop.set).start()
+        self.assertEqual(queue.work(worker_id='node-1', stop=stop), 0)
+        self.assertFalse(os.path.exists(os.path.join(self._tmp_dir, 'out', 'lost.pptx')))
+        self.assertEqual(queue.report()['running'], 1)
+
+    def test_06_job_is_given_up_when_heartbeat_fails(self):
+        class LockedQueue(JobQueue):
+            def heartbeat(self, job_id, worker_id):
+                raise sqlite3.OperationalError("database is locked")
+
+            def process(self, job, cancellation_token=None):
+                time.sleep(0.2)
+                return JobQueue.process(self, job, cancellation_token)
+
+        queue = LockedQueue(self._database, lease=0.3)
+        queue.enqueue([ { 'input': 'tests/data/test-03.pptx',
+                          'output': os.path.join(self._tmp_dir, 'out', 'locked.pptx'),
+                          'replacements': [ [ 'are', 'ARE' ] ] } ])
+        stop = threading.Event()
+        threading.Timer(0.5, stop.set).start()
+        self.assertEqual(queue.work(worker_id='node-1', stop=stop), 0)
+        self.assertFalse(os.path.exists(os.path.join(self._tmp_dir, 'out', 'locked.pptx')))
+
+    def test_07_job_taken_over_is_not_counted(self):
+        class OvertakenQueue(JobQueue):
+            def process(self, job, cancellation_token=None):
+                stats = JobQueue.process(self, job, cancellation_token)
+                # another worker took the job over and finished it in the meantime
+                with self._transaction() as db:
+                    db.execute("UPDATE jobs SET state='done', worker='node-2', stats='{}', finished=? WHERE id=?", ( time.time(), job['id'] ))
+                return stats
+
+        queue = OvertakenQueue(self._database)
+        queue.enqueue([ { 'input': 'tests/data/test-03.pptx',
+                          'output': os.path.join(self._tmp_dir, 'out', 'overtaken.pptx'),
+                          'replacements': [ [ 'are', 'ARE' ] ] } ])
+        self.assertEqual(queue.work(worker_id='node-1'), 0)
+        self.assertEqual(queue.report()['workers'], { 'node-2': 1 })
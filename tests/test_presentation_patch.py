@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import zipfile
+
+from python_pptx_text_replacer import TextReplacer
+from python_pptx_text_replacer.PresentationPatch import apply_patch
+
+
+class test_presentation_patch(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp()
+        self._stdout = sys.stdout
+        sys.stdout = io.StringIO()
+
+    def tearDown(self):
+        sys.stdout = self._stdout
+        shutil.rmtree(self._tmp_dir)
+
+    def patch_and_apply(self, input_file, replacements):
+        patch_file = os.path.join(self._tmp_dir, 'changes.patch')
+        full_file = os.path.join(self._tmp_dir, 'full.pptx')
+        output_file = os.path.join(self._tmp_dir, 'output.pptx')
+        replacer = TextReplacer(input_file)
+        replacer.replace_text(replacements)
+        replacer.write_presentation_patch(patch_file)
+        replacer.write_presentation_to_file(full_file)
+        apply_patch(input_file, patch_file, output_file)
+        with zipfile.ZipFile(patch_file) as patch:
+            manifest = json.loads(patch.read('manifest.json').decode('utf-8'))
+        with zipfile.ZipFile(input_file) as original, \
+             zipfile.ZipFile(full_file) as full, \
+             zipfile.ZipFile(output_file) as output:
+            self.assertEqual(output.namelist(), full.namelist())
+            for name in output.namelist():
+                if name in manifest['changed']:
+                    self.assertEqual(output.read(name), full.read(name))
+                else:
+                    # unchanged members are copied raw from the original
+                    self.assertEqual(output.getinfo(name).CRC, original.getinfo(name).CRC)
+                    self.assertEqual(output.read(name), original.read(name))
+        return manifest
+
+    def test_01_patch_with_changed_slides(self):
+        manifest = self.patch_and_apply('tests/data/Test-Presentation.pptx', [('Text','TXT')])
+        self.assertEqual(sorted(manifest['changed']),
+                         ['ppt/slides/_rels/slide3.xml.rels', 'ppt/slides/_rels/slide4.xml.rels',
+                          'ppt/slides/slide3.xml', 'ppt/slides/slide4.xml'])
+
+    def test_02_patch_with_changed_chart(self):
+        manifest = self.patch_and_apply('tests/data/chart-01.pptx', [('FY2021','FY2021/22')])
+        self.assertIn('ppt/charts/chart1.xml', manifest['changed'])
+        self.assertTrue(any(name.startswith('ppt/embeddings/') for name in manifest['changed']))
+
+    def test_03_patch_for_other_presentation_is_rejected(self):
+        patch_file = os.path.join(self._tmp_dir, 'changes.patch')
+        replacer = TextReplacer('tests/data/test-03.pptx')
+        replacer.replace_text([('are','ARE')])
+        replacer.write_presentation_patch(patch_file)
+        with self.assertRaises(ValueError):
+            apply_patch('tests/data/test-04.pptx', patch_file, os.path.join(self._tmp_dir, 'output.pptx'))
+        self.assertFalse(os.path.exists(os.path.join(self._tmp_dir, 'output.pptx')))
+
+    def test_04_patch_of_reordered_presentation(self):
+        from pptx import Presentation
+        from pptx.util import Inches
+        prs = Presentation()
+        for text in ('FIRST Text', 'SECOND plain'):
+            slide = prs.slides.add_slide(prs.slide_layouts[6])
+            slide.shapes.add_textbox(Inches(1), Inches(1), Inches(4), Inches(1)).text_frame.text = text
+        # move the second slide to the front, like PowerPoint does it, without renaming the slide parts
+        sldIdLst = prs.slides._sldIdLst
+        sldIdLst.insert(0, sldIdLst[1])
+        input_file = os.path.join(self._tmp_dir, 'reordered.pptx')
+        prs.save(input_file)
+        self.patch_and_apply(input_file, [('plain','PLAIN')])
+        output = Presentation(os.path.join(self._tmp_dir, 'output.pptx'))
+        self.assertEqual([ slide.shapes[0].text_frame.text for slide in output.slides ], ['SECOND PLAIN', 'FIRST Text'])
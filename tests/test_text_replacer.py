@@ -4,6 +4,7 @@ from __future__ import print_function, unicode_literals
 
 import os
 import sys
+import io
 import unittest
 from io import open as open, StringIO
 from python_pptx_text_replacer import TextReplacer
@@ -323,3 +324,209 @@ Slide[1].TEXT_BOX[id=3].Run[0,3]: ' you?' -> 'e!'
     def test_09_quiet_regex_across_runs_via_main(self):
         self.do_test_via_main('tests/data/test-04.pptx',True,False,False,'',[(r'How ..(.) you\?',r"I'm fin\1!")],'','',use_regex=True,verbose=False,quiet=True)
 
+
+    def test_10_staged_replacements_reuse_text_containers(self):
+        with Capture(None) as capture:
+            replacer = TextReplacer('tests/data/Test-Presentation.pptx')
+            replacer.replace_text([('Text','Txt')])
+            containers = replacer._get_text_containers('slide')
+            replacer.replace_text([('Txt','TEXT')])
+            self.assertIs(replacer._get_text_containers('slide'), containers)
+        result = self.check_output('stdout',"""Slide[3].PLACEHOLDER[id=2].Run[0,0]: 'A Textbox' -> 'A Txtbox'
+Slide[4].AUTO_SHAPE[id=3].Run[1,0]: 'Text' -> 'Txt'
+Slide[4].AUTO_SHAPE[id=4].Run[1,0]: 'Text' -> 'Txt'
+Slide[3].PLACEHOLDER[id=2].Run[0,0]: 'A Txtbox' -> 'A TEXTbox'
+Slide[4].AUTO_SHAPE[id=3].Run[1,0]: 'Txt' -> 'TEXT'
+Slide[4].AUTO_SHAPE[id=4].Run[1,0]: 'Txt' -> 'TEXT'
+""",capture.stdout())
+        if len(result) > 0:
+            self.fail('\n'.join(result))
+
+    def test_11_table_skips_merged_and_empty_cells(self):
+        from pptx import Presentation
+        from pptx.util import Inches
+        import tempfile
+        prs = Presentation()
+        slide = prs.slides.add_slide(prs.slide_layouts[6])
+        table = slide.shapes.add_table(3, 3, Inches(1), Inches(1), Inches(6), Inches(2)).table
+        table.cell(0,0).merge(table.cell(0,1))
+        table.cell(0,0).text = 'merged cell'
+        table.cell(0,2).text = 'a cell'
+        table.cell(1,0).merge(table.cell(2,0))
+        table.cell(1,0).text = 'tall cell'
+        table.cell(2,2).text = 'last cell'
+        fd, file_name = tempfile.mkstemp(suffix='.pptx')
+        os.close(fd)
+        try:
+            prs.save(file_name)
+            with Capture(None) as capture:
+                replacer = TextReplacer(file_name, textframes=False, charts=False)
+                replacer.replace_text([('cell','CELL')], edit_slide_master=False)
+            result = self.check_output('stdout',"""Slide[1].TABLE[id=2].Run[0,0]: 'merged cell' -> 'merged CELL'
+Slide[1].TABLE[id=2].Run[0,0]: 'a cell' -> 'a CELL'
+Slide[1].TABLE[id=2].Run[0,0]: 'tall cell' -> 'tall CELL'
+Slide[1].TABLE[id=2].Run[0,0]: 'last cell' -> 'last CELL'
+""",capture.stdout())
+            cells = list(container[3:5] for container in replacer._get_text_containers('slide') if container[0] == 'cell')
+            self.assertEqual(cells, [(0,0),(0,2),(1,0),(2,2)])
+        finally:
+            os.unlink(file_name)
+        if len(result) > 0:
+            self.fail('\n'.join(result))
+
+    def test_12_slide_master_cache(self):
+        from python_pptx_text_replacer import SlideMasterCache
+        cache = SlideMasterCache()
+        masters = []
+        matches = []
+        outputs = []
+        for _ in range(2):
+            with Capture(None) as capture:
+                replacer = TextReplacer('tests/data/Test-Presentation.pptx')
+                replacer.replace_text([('Master','MASTER')], master_cache=cache)
+            master = replacer._presentation.slide_masters[0]
+            masters.append(master.part.blob)
+            matches.append(replacer.get_run_stats()['matches'])
+            outputs.append(capture.stdout())
+            titles = list(shape.text_frame.text for shape in master.shapes if shape.has_text_frame)
+            self.assertIn('Click to edit MASTER title style', titles)
+        self.assertEqual(cache.misses, 1)
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(masters[0], masters[1])
+        # the matches and changes of a cached slide master are reported just the same
+        self.assertEqual(matches, [ 2, 2 ])
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertEqual(len(outputs[1]), 2)
+
+    def test_13_progress_and_run_stats(self):
+        from python_pptx_text_replacer import TextReplacer as TR
+        calls = []
+        with Capture(None) as capture:
+            replacer = TR('tests/data/Test-Presentation.pptx', quiet=True)
+            replacer.replace_text([('Text','Txt')], progress=lambda *args: calls.append(args))
+        self.assertEqual(list((done, total, matches) for (done, total, matches, elapsed) in calls),
+                         [(1,5,0),(2,5,0),(3,5,1),(4,5,3),(5,5,3)])
+        stats = replacer.get_run_stats()
+        self.assertEqual((stats['slides'], stats['slide_count'], stats['matches']), (5, 5, 3))
+
+    def test_14_cancellation(self):
+        from python_pptx_text_replacer import CancellationToken, ReplacementCancelled
+        token = CancellationToken()
+        def cancel_after_second_slide(slides_done, slide_count, matches, elapsed):
+            if slides_done == 2:
+                token.cancel()
+        with Capture(None) as capture:
+            replacer = TextReplacer('tests/data/Test-Presentation.pptx', quiet=True)
+            with self.assertRaises(ReplacementCancelled):
+                replacer.replace_text([('Text','Txt')], progress=cancel_after_second_slide, cancellation_token=token)
+        self.assertEqual(replacer.get_run_stats()['slides'], 2)
+        self.assertEqual(replacer.get_run_stats()['matches'], 0)
+
+    def test_15_memory_tracking(self):
+        with Capture(None) as capture:
+            replacer = TextReplacer('tests/data/chart-01.pptx', quiet=True, track_memory=True)
+            replacer.replace_text([('FY2021','FY2021/22')])
+            replacer.write_presentation_to_file(io.BytesIO())
+        memory = replacer.get_run_stats()['memory']
+        self.assertEqual(sorted(memory), ['chart rebuild', 'load', 'save', 'traverse'])
+        for phase in memory.values():
+            self.assertGreater(phase['peak_traced'], 0)
+            self.assertGreaterEqual(phase['peak_rss_increase'], 0)
+            self.assertGreaterEqual(phase['peak_rss'], phase['peak_rss_increase'])
+
+    def test_16_memory_budget(self):
+        from python_pptx_text_replacer import MemoryBudgetExceeded
+        with self.assertRaises(MemoryBudgetExceeded):
+            TextReplacer('tests/data/Test-Presentation.pptx', memory_budget=1024)
+        with Capture(None) as capture:
+            replacer = TextReplacer('tests/data/Test-Presentation.pptx', quiet=True, memory_budget=2**30)
+            # pretend most of the budget is used up already
+            replacer._memory.used = lambda: 2**30 * 7 // 8
+            replacer.replace_text([('Text','Txt')])
+            self.assertEqual(replacer._text_containers, {})
+            # the text containers are produced slide by slide instead of as one list
+            self.assertNotIsInstance(replacer._get_text_containers("slide"), list)
+            replacer._memory.used = lambda: 2**30 + 1
+            with self.assertRaises(MemoryBudgetExceeded):
+                replacer.replace_text([('Txt','Text')])
+        self.assertIn('switching to low memory mode', ''.join(capture.stderr()))
+
+    def test_17_unselected_slides_are_not_parsed(self):
+        import zipfile
+        from pptx.opc.package import Part
+        with Capture(None) as capture:
+            replacer = TextReplacer('tests/data/Test-Presentation.pptx', slides='1,3-')
+            replacer.replace_text([('Text','TXT'),('FY','fy')], verbose=True, edit_slide_master=False)
+            output = io.BytesIO()
+            replacer.write_presentation_to_file(output)
+        parts = dict((str(part.partname), part) for part in replacer._presentation.part.package.iter_parts())
+        self.assertIs(type(parts['/ppt/slides/slide2.xml']), Part)
+        self.assertIs(type(parts['/ppt/charts/chart1.xml']), Part)
+        self.assertIsNot(type(parts['/ppt/slides/slide3.xml']), Part)
+        self.assertIn('  Slide[2, id=257] not loaded\n', capture.stdout())
+        with zipfile.ZipFile('tests/data/Test-Presentation.pptx') as original, zipfile.ZipFile(output) as changed:
+            for name in ('ppt/slides/slide2.xml', 'ppt/charts/chart1.xml'):
+                self.assertEqual(changed.read(name), original.read(name))
+            self.assertIn(b'A TXTbox', changed.read('ppt/slides/slide3.xml'))
+
+    def test_18_repeated_text_frames_reuse_edit_plans(self):
+        import tempfile
+        from pptx import Presentation
+        from pptx.util import Inches, Pt
+        prs = Presentation()
+        for _ in range(3):
+            slide = prs.slides.add_slide(prs.slide_layouts[6])
+            paragraph = slide.shapes.add_textbox(Inches(1), Inches(6), Inches(6), Inches(1)).text_frame.paragraphs[0]
+            for run_idx, text in enumerate(('Confid', 'ential FY20', '21')):
+                run = paragraph.add_run()
+                run.text = text
+                run.font.size = Pt(8 + run_idx)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_name = os.path.join(tmp_dir, 'footer.pptx')
+            prs.save(file_name)
+            with Capture(None) as capture:
+                replacer = TextReplacer(file_name)
+                replacer.replace_text([('Confidential','Internal'),('FY2021','FY2122')], edit_slide_master=False)
+        stats = replacer.get_run_stats()
+        self.assertEqual((stats['matches'], stats['edit_plans_reused']), (6, 2))
+        for slide in replacer._presentation.slides:
+            runs = slide.shapes[0].text_frame.paragraphs[0].runs
+            self.assertEqual([ run.text for run in runs ], [ 'Intern', 'al FY21', '22' ])
+            self.assertEqual([ run.font.size for run in runs ], [ Pt(8), Pt(9), Pt(10) ])
+        self.assertIn("Slide[3].TEXT_BOX[id=2].Run[0,1]: 'al FY20' -> 'al FY21'\n", capture.stdout())
+
+    @unittest.skipUnless(os.path.exists('/proc/self/statm'), "needs the current RSS from /proc")
+    def test_19_memory_is_tracked_per_phase(self):
+        from python_pptx_text_replacer.MemoryTracker import MemoryTracker, MemoryPhase
+        tracker = MemoryTracker()
+        # raise the all-time peak RSS of the process well above what the phases need
+        ballast = bytearray(200 * 2**20)
+        for i in range(0, len(ballast), 4096):
+            ballast[i] = 1
+        del ballast
+        with MemoryPhase(tracker, 'small'):
+            small = bytearray(2**20)
+        with MemoryPhase(tracker, 'large'):
+            large = bytearray(64 * 2**20)
+            for i in range(0, len(large), 4096):
+                large[i] = 1
+        del small, large
+        stats = tracker.get_stats()
+        self.assertLess(stats['small']['peak_rss_increase'], 32 * 2**20)
+        self.assertGreater(stats['large']['peak_rss_increase'], 32 * 2**20)
+
+    def test_20_concurrent_trackers_share_the_tracing(self):
+        import tracemalloc
+        from python_pptx_text_replacer.MemoryTracker import MemoryTracker
+        first = MemoryTracker(trace=True)
+        second = MemoryTracker(trace=True)
+        first.start('load')
+        second.start('load')
+        first.stop()
+        # the first tracker must not stop the tracing of the second one
+        self.assertTrue(tracemalloc.is_tracing())
+        data = bytearray(4 * 2**20)
+        second.stop()
+        del data
+        self.assertFalse(tracemalloc.is_tracing())
+        self.assertGreater(second.get_stats()['load']['peak_traced'], 4 * 2**20)